@@ -87,6 +87,20 @@ export async function saveProjectState(projectId, stateData) {
     }
 }
 
+// Paged image list: { total, offset, images: [{ name, path, index, width, height, annotated }] }
+export async function listProjectImages(projectId, offset = 0, limit = 100, annotated = null) {
+    try {
+        let url = `${API_URL}/projects/${projectId}/images?offset=${offset}&limit=${limit}`;
+        if (annotated !== null) url += `&annotated=${annotated}`;
+        const res = await fetch(url);
+        if (!res.ok) return { total: 0, offset, images: [] };
+        return await res.json();
+    } catch (e) {
+        console.error("Error listing project images:", e);
+        return { total: 0, offset, images: [] };
+    }
+}
+
 // --- ANNOTATIONS ---
 
 export async function loadAnnotationFromDB(projectId, imageName) {
@@ -117,8 +131,29 @@ export async function saveAnnotationToDB(projectId, imageName, annotations) {
     }
 }
 
+// Send only the changed shapes. Returns { version, added_ids } or { conflict: true, version } on a stale base.
+export async function saveAnnotationDelta(projectId, imageName, baseVersion, { added = [], modified = [], deleted = [] }) {
+    try {
+        const res = await fetch(`${API_URL}/save_annotation_delta`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({
+                project_id: projectId,
+                image_name: imageName,
+                base_version: baseVersion,
+                added, modified, deleted
+            })
+        });
+        return await res.json();
+    } catch (e) {
+        console.error("Error saving annotation delta:", e);
+        return { error: e.message };
+    }
+}
+
 // --- IMAGING ---
-export async function loadImageToBackend(fileOrPath) {
+// Resolves to the image_key that segmentPoints, segmentBatch and autoSegment take, or null on failure.
+export async function loadImageToBackend(fileOrPath, projectId = null, imageName = null) {
     try {
         // Use the new path-based endpoint with embedding caching
         if (typeof fileOrPath === 'string') {
@@ -126,12 +161,12 @@ export async function loadImageToBackend(fileOrPath) {
             const res = await fetch(`${API_URL}/load_image_path`, {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
-                body: JSON.stringify({ path: fileOrPath })
+                body: JSON.stringify({ path: fileOrPath, project_id: projectId, image_name: imageName })
             });
             const data = await res.json();
             if (data.error) {
                 console.error("Backend Image Load Error:", data.error);
-                return false;
+                return null;
             }
 
             if (data.cached) {
@@ -139,18 +174,19 @@ export async function loadImageToBackend(fileOrPath) {
             } else {
                 console.log("📦 Image encoded and cached");
             }
-            return true;
+            return data.image_key;
         } else if (fileOrPath instanceof File) {
             // Fallback to FormData upload
             const fd = new FormData();
             fd.append("file", fileOrPath);
-            await fetch(`${API_URL}/load_image`, { method: "POST", body: fd });
-            return true;
+            const res = await fetch(`${API_URL}/load_image`, { method: "POST", body: fd });
+            const data = await res.json();
+            return data.image_key || null;
         }
-        return false;
+        return null;
     } catch (e) {
         console.error("Load Image Error:", e);
-        return false;
+        return null;
     }
 }
 
@@ -166,12 +202,12 @@ export async function getProjectStats(projectId) {
     }
 }
 
-export async function segmentPoints(points, imageName) {
+export async function segmentPoints(points, imageKey) {
     try {
         const res = await fetch(`${API_URL}/segment`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ points, image_name: imageName })
+            body: JSON.stringify({ points, image_key: imageKey })
         });
         if (!res.ok) {
             console.error("Segment failed:", res.statusText);
@@ -184,21 +220,103 @@ export async function segmentPoints(points, imageName) {
     }
 }
 
+export async function segmentBatch(prompts, imageKey) {
+    try {
+        const res = await fetch(`${API_URL}/segment_batch`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ prompts, image_key: imageKey })
+        });
+        if (!res.ok) {
+            console.error("Batch segment failed:", res.statusText);
+            return { error: "Backend Error: " + res.statusText };
+        }
+        return await res.json();
+    } catch (e) {
+        console.error("Batch Segment Network Error:", e);
+        return { error: "Network Error: Is backend running?" };
+    }
+}
+
+// Streams automatic mask proposals. onProposal receives each { polygon, score, stability, box, point }
+// as it arrives; resolves to the final { done, count, elapsed_ms } line or { error }.
+export async function autoSegment(imageKey, options = {}, onProposal = null) {
+    try {
+        const res = await fetch(`${API_URL}/auto_segment`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ image_key: imageKey, ...options })
+        });
+        if (!res.ok) {
+            console.error("Auto segment failed:", res.statusText);
+            return { error: "Backend Error: " + res.statusText };
+        }
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = "";
+        let summary = { error: "Stream ended early" };
+        let failure = null;
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split("\n");
+            buffered = lines.pop();
+            for (const line of lines) {
+                if (!line) continue;
+                const msg = JSON.parse(line);
+                if (msg.error) failure = msg;
+                else if (msg.done) summary = msg;
+                else if (onProposal) onProposal(msg);
+            }
+        }
+        return failure || summary;
+    } catch (e) {
+        console.error("Auto Segment Network Error:", e);
+        return { error: "Network Error: Is backend running?" };
+    }
+}
+
 // --- EXPORT ---
-export async function exportProjectData(projectId, format, outputDir) {
+// Runs the export as a background job and polls it. onProgress receives the job status
+// ({ status, done, total, percent }). Resolves to { path } on success or { error }.
+export async function exportProjectData(projectId, format, outputDir, onProgress = null, incremental = false) {
     try {
-        const res = await fetch(`${API_URL}/export`, {
+        const res = await fetch(`${API_URL}/export_jobs`, {
             method: "POST",
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({
                 project_id: projectId,
                 format: format,
-                output_dir: outputDir
+                output_dir: outputDir,
+                incremental: incremental
             })
         });
         if (!res.ok) {
             return { error: `Export Failed: ${res.statusText}` };
         }
+        let job = await res.json();
+        if (job.error) return job;
+
+        while (job.status === "queued" || job.status === "running") {
+            if (onProgress) onProgress(job);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const poll = await fetch(`${API_URL}/export_jobs/${job.job_id}`);
+            if (!poll.ok) return { error: `Export Failed: ${poll.statusText}` };
+            job = await poll.json();
+        }
+
+        if (job.status === "completed") return { status: "success", path: job.path };
+        return { error: job.error || `Export ${job.status}` };
+    } catch (e) {
+        return { error: "Export Network Error" };
+    }
+}
+
+export async function cancelExportJob(jobId) {
+    try {
+        const res = await fetch(`${API_URL}/export_jobs/${jobId}/cancel`, { method: "POST" });
         return await res.json();
     } catch (e) {
         return { error: "Export Network Error" };
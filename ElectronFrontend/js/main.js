@@ -54,6 +54,7 @@ window.triggerExport = async (format) => {
 
 let currentPoints = [];
 let tempPolygon = null;
+let currentImageKey = null; // Backend session key of the open image, from loadImageToBackend
 let rawFiles = [];
 let pendingFolderPath = "";
 
@@ -204,7 +205,7 @@ async function updateSegmentation() {
     }
 
     setLoading(true);
-    const data = await segmentPoints(currentPoints, state.images[state.lastIndex]);
+    const data = await segmentPoints(currentPoints, currentImageKey);
     setLoading(false);
 
     if (data && data.error) {
@@ -434,7 +435,7 @@ async function scanProjectFolder(folderPath) {
         if (state.images.length > 0) {
             state.lastIndex = 0;
             // Save this initial state to DB
-            await saveSession();
+            await saveSession(true);
 
             updateFileList(loadInternalImage);
             loadInternalImage(0);
@@ -493,8 +494,9 @@ async function loadInternalImage(index) {
         redraw();
 
         // Sync
-        const loaded = await loadImageToBackend(filePath);
-        if (!loaded) {
+        currentImageKey = null;
+        currentImageKey = await loadImageToBackend(filePath, state.currentProjectId, fileName);
+        if (!currentImageKey) {
             showToast("AI Backend Error: Image not loaded", "warning");
         }
     };
@@ -538,7 +540,7 @@ document.getElementById("folderPicker").onchange = async (e) => {
     state.images = files.map(f => f.name);
     state.lastIndex = 0;
 
-    await saveSession();
+    await saveSession(true);
     updateFileList(loadInternalImage);
     loadInternalImage(state.lastIndex);
 };
@@ -49,14 +49,16 @@ export async function loadProjectSession(project) {
     return state;
 }
 
-export async function saveSession() {
+// The image list is only sent when it changed (folder opened); the backend keeps it in its own table.
+export async function saveSession(includeImages = false) {
     if (!state.currentProjectId) return;
 
-    await saveProjectState(state.currentProjectId, {
+    const data = {
         lastIndex: state.lastIndex,
-        categories: state.categories,
-        imagePaths: state.imagePaths
-    });
+        categories: state.categories
+    };
+    if (includeImages) data.imagePaths = state.imagePaths;
+    await saveProjectState(state.currentProjectId, data);
 }
 
 // --- ANNOTATIONS ---
@@ -1,13 +1,23 @@
 from fastapi import APIRouter, Body, UploadFile, File
-from typing import Dict, List, Any
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, List, Any, Optional
 import json
+import time
 import sqlite3
 import cv2
 import numpy as np
 
+from app.core.config import get_settings
 from app.core.database import get_db_connection
 from app.services.ai_service import ai_service
 from app.services.export_service import export_service
+from app.services.annotation_service import annotation_service
+from app.services.prefetch_service import prefetch_service
+from app.services.inference_executor import inference_executor
+from app.services.autosave_service import autosave_service
+from app.services.image_service import image_service
+from app.services.export_jobs import export_job_service
 
 router = APIRouter()
 
@@ -36,24 +46,30 @@ def create_project(data: dict = Body(...)):
 
 @router.delete("/projects/{project_id}")
 def delete_project(project_id: int):
+    autosave_service.discard(project_id)
     with get_db_connection() as conn:
         conn.execute("DELETE FROM projects WHERE id = ?", (project_id,))
         conn.execute("DELETE FROM project_state WHERE project_id = ?", (project_id,))
-        conn.execute("DELETE FROM annotations_v2 WHERE project_id = ?", (project_id,))
+        annotation_service.delete_project(conn, project_id)
+        image_service.delete_project(conn, project_id)
         conn.commit()
     return {"status": "deleted"}
 
 @router.get("/projects/{project_id}/state")
-def get_project_state(project_id: int):
+def get_project_state(project_id: int, include_images: bool = True):
     with get_db_connection() as conn:
-        cursor = conn.execute("SELECT last_index, categories, image_paths FROM project_state WHERE project_id = ?", (project_id,))
+        cursor = conn.execute("SELECT last_index, categories FROM project_state WHERE project_id = ?", (project_id,))
         row = cursor.fetchone()
         if row:
-            return {
+            state = {
                 "lastIndex": row[0],
                 "categories": json.loads(row[1]) if row[1] else [],
-                "imagePaths": json.loads(row[2]) if row[2] else {}
+                "imageCount": image_service.count(conn, project_id),
             }
+            # Large projects can skip the full list and page through /projects/{id}/images instead
+            if include_images:
+                state["imagePaths"] = image_service.image_paths(conn, project_id)
+            return state
         return {}
 
 @router.post("/projects/{project_id}/save_state")
@@ -64,74 +80,200 @@ def save_project_state(project_id: int, data: dict = Body(...)):
         if "categories" in data:
             conn.execute("UPDATE project_state SET categories = ? WHERE project_id = ?", (json.dumps(data["categories"]), project_id))
         if "imagePaths" in data:
-            conn.execute("UPDATE project_state SET image_paths = ? WHERE project_id = ?", (json.dumps(data["imagePaths"]), project_id))
+            total = image_service.replace_images(conn, project_id, data["imagePaths"])
+            annotation_service.set_total_images(conn, project_id, total)
         conn.commit()
     return {"status": "saved"}
 
-@router.get("/projects/{project_id}/stats")
-def get_project_stats(project_id: int):
+@router.get("/projects/{project_id}/images")
+def list_project_images(project_id: int, offset: int = 0, limit: int = 100, annotated: Optional[bool] = None):
+    limit = max(1, min(limit, 1000))
     with get_db_connection() as conn:
-        cursor = conn.execute("SELECT image_paths FROM project_state WHERE project_id = ?", (project_id,))
-        row = cursor.fetchone()
-        image_paths = json.loads(row[0]) if row and row[0] else {}
-        total_images = len(image_paths)
-        
-        cursor = conn.execute("SELECT COUNT(*) FROM annotations_v2 WHERE project_id = ?", (project_id,))
-        annotated_count = cursor.fetchone()[0]
-        
-        cursor = conn.execute("SELECT data FROM annotations_v2 WHERE project_id = ?", (project_id,))
-        class_dist = {}
-        for row in cursor.fetchall():
-            annotations = json.loads(row[0]) if row[0] else []
-            for ann in annotations:
-                cls = ann.get("className", "Unknown")
-                class_dist[cls] = class_dist.get(cls, 0) + 1
-        
         return {
-            "total_images": total_images,
-            "annotated_count": annotated_count,
-            "class_distribution": class_dist
+            "total": image_service.count(conn, project_id, annotated),
+            "offset": offset,
+            "images": image_service.list_images(conn, project_id, offset, limit, annotated),
         }
 
+@router.get("/projects/{project_id}/stats")
+def get_project_stats(project_id: int):
+    autosave_service.flush(project_id)
+    with get_db_connection() as conn:
+        return annotation_service.project_stats(conn, project_id)
+
 # --- ANNOTATIONS ---
 
 @router.post("/save_annotation")
 def save_annotation(data: dict = Body(...)):
     project_id = data.get("project_id")
     img_name = data.get("image_name")
-    annotations_str = json.dumps(data.get("annotations"))
-    
-    with get_db_connection() as conn:
-        conn.execute("INSERT OR REPLACE INTO annotations_v2 (project_id, image_name, data) VALUES (?, ?, ?)", 
-                     (project_id, img_name, annotations_str))
-        conn.commit()
-    return {"status": "success"}
+    if data.get("sync"):
+        # Caller needs the shape ids / version back, so write through
+        autosave_service.flush(project_id, img_name)
+        result = annotation_service.save_annotations(project_id, img_name, data.get("annotations"))
+        return {"status": "success", **result}
+    try:
+        autosave_service.enqueue(project_id, img_name, data.get("annotations"))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+    return {"status": "queued"}
+
+@router.post("/save_annotation_delta")
+def save_annotation_delta(data: dict = Body(...)):
+    try:
+        base_version = _option(data, "base_version", 0, int, minimum=0)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+    autosave_service.flush(data.get("project_id"), data.get("image_name"))
+    return annotation_service.apply_delta(
+        data.get("project_id"),
+        data.get("image_name"),
+        base_version,
+        added=data.get("added"),
+        modified=data.get("modified"),
+        deleted=data.get("deleted"),
+    )
 
 @router.get("/load_annotation")
 def load_annotation(project_id: int, image_name: str):
-    with get_db_connection() as conn:
-        cursor = conn.execute("SELECT data FROM annotations_v2 WHERE project_id = ? AND image_name = ?", (project_id, image_name))
-        row = cursor.fetchone()
-        return {"annotations": json.loads(row[0]) if row else []}
+    autosave_service.flush(project_id, image_name)
+    annotations, version = annotation_service.load_annotations(project_id, image_name)
+    return {"annotations": annotations, "version": version}
 
 # --- AI & EXPORT ---
 
 @router.get("/status")
 def status():
-    return {"status": f"AI_READY ({ai_service.device})"}
+    return {"status": f"AI_READY ({ai_service.device})", "profile": ai_service.perf_profile}
+
+@router.get("/autosave_stats")
+def autosave_stats():
+    return autosave_service.stats()
 
 @router.post("/load_image_path")
 async def load_image_from_path(data: dict = Body(...)):
     path = data.get("path")
+    project_id = data.get("project_id")
+    image_name = data.get("image_name")
     try:
-        return await ai_service.load_image_path(path)
+        # Duplicate loads of the same image await the job already in flight
+        result = await inference_executor.submit(("load_image_path", path), ai_service.load_image_path, path)
     except Exception as e:
         return {"error": str(e)}
+    if project_id is not None:
+        if image_name:
+            await run_in_threadpool(
+                _record_image_load, project_id, image_name, path, result["width"], result["height"], result.get("content_hash"))
+        await run_in_threadpool(prefetch_service.schedule, project_id, path)
+    return result
+
+def _record_image_load(project_id: int, image_name: str, path: str, width: int, height: int, content_hash: str):
+    with get_db_connection() as conn:
+        image_service.record_load(conn, project_id, image_name, path, width, height, content_hash)
+        conn.commit()
 
 @router.post("/segment")
 def segment(data: dict = Body(...)):
-    return ai_service.segment(data.get("points"))
+    image_key = data.get("image_key")
+    try:
+        return ai_service.segment(
+            data.get("points"),
+            image_key,
+            labels=data.get("labels"),
+            box=data.get("box"),
+            reset=bool(data.get("reset", False)),
+            multi_component=bool(data.get("multi_component", False)),
+            with_holes=bool(data.get("holes", False)),
+        )
+    except ValueError as e:
+        return JSONResponse({"polygon": [], "error": str(e)}, status_code=422)
+
+@router.post("/segment_batch")
+def segment_batch(data: dict = Body(...)):
+    image_key = data.get("image_key")
+    try:
+        return ai_service.segment_batch(data.get("prompts"), image_key)
+    except ValueError as e:
+        return JSONResponse({"results": [], "error": str(e)}, status_code=422)
+
+def _option(data: dict, name: str, default, cast, minimum=None, maximum=None):
+    """A request option: missing or null means the default; a value of the wrong type or out of range raises ValueError."""
+    value = data.get(name)
+    if value is None:
+        return default
+    if cast is bool:
+        if not isinstance(value, bool):
+            raise ValueError(f"{name} must be true or false")
+        return value
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be a number")
+    try:
+        value = cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be {'an integer' if cast is int else 'a number'}") from None
+    # Written as negations so NaN is rejected too
+    if (minimum is not None and not value >= minimum) or (maximum is not None and not value <= maximum):
+        raise ValueError(f"{name} is out of range")
+    return value
+
+@router.post("/auto_segment")
+def auto_segment(data: dict = Body(...)):
+    """
+    Stream automatic mask proposals for a loaded image as NDJSON: one proposal per line as it
+    passes filtering, then {"done": true, "count": n, "elapsed_ms": t}.
+    """
+    settings = get_settings()
+    try:
+        proposals = ai_service.auto_segment(
+            data.get("image_key"),
+            points_per_side=_option(data, "points_per_side", 32, int, minimum=1, maximum=64),
+            pred_iou_thresh=_option(data, "pred_iou_thresh", 0.8, float, minimum=0.0, maximum=1.0),
+            stability_score_thresh=_option(data, "stability_score_thresh", 0.95, float, minimum=0.0, maximum=1.0),
+            crop_n_layers=_option(data, "crop_n_layers", 0, int, minimum=0, maximum=2),
+            low_res_filter=_option(data, "low_res_filter", True, bool),
+            # The budgets can be lowered per request but never raised past the server's limits
+            max_seconds=min(_option(data, "max_seconds", settings.AUTO_SEGMENT_MAX_SECONDS, float, minimum=0.0),
+                            settings.AUTO_SEGMENT_MAX_SECONDS),
+            max_masks=min(_option(data, "max_masks", settings.AUTO_SEGMENT_MAX_MASKS, int, minimum=1),
+                          settings.AUTO_SEGMENT_MAX_MASKS),
+            multi_component=_option(data, "multi_component", False, bool),
+            with_holes=_option(data, "holes", False, bool),
+        )
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+
+    def lines():
+        start = time.perf_counter()
+        count = 0
+        for proposal in proposals:
+            if "error" not in proposal:
+                count += 1
+            yield json.dumps(proposal) + "\n"
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+        yield json.dumps({"done": True, "count": count, "elapsed_ms": elapsed_ms}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 @router.post("/export")
 def export_project_data(data: dict = Body(...)):
-    return export_service.export_project(data.get("project_id"), data.get("format"))
+    # Synchronous; the app uses /export_jobs so large exports do not hold the request open
+    autosave_service.flush(data.get("project_id"))
+    return export_service.export_project(
+        data.get("project_id"), data.get("format"), incremental=bool(data.get("incremental", False)))
+
+@router.post("/export_jobs")
+def submit_export_job(data: dict = Body(...)):
+    return export_job_service.submit(
+        data.get("project_id"), data.get("format"), incremental=bool(data.get("incremental", False)))
+
+@router.get("/export_jobs/{job_id}")
+def get_export_job(job_id: int):
+    return export_job_service.get(job_id) or {"error": "Export job not found"}
+
+@router.post("/export_jobs/{job_id}/cancel")
+def cancel_export_job(job_id: int):
+    return export_job_service.cancel(job_id) or {"error": "Export job not found"}
+
+@router.get("/projects/{project_id}/export_jobs")
+def list_export_jobs(project_id: int, limit: int = 20):
+    return export_job_service.list_jobs(project_id, limit)
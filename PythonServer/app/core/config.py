@@ -13,13 +13,42 @@ class Settings:
     CHECKPOINT_PATH: str = os.path.join(ROOT_DIR, "checkpoints", "sam2.1_hiera_small.pt")
     MODEL_CONFIG_PATH: str = os.path.join(ROOT_DIR, "configs", "sam2.1", "sam2.1_hiera_s.yaml")
     DB_PATH: str = os.path.join(ROOT_DIR, "project_data.db")
+    DB_MMAP_SIZE: int = 256 * 1024 * 1024
+    DB_STATEMENT_CACHE_SIZE: int = 256
     MASK_DIR: str = os.path.join(ROOT_DIR, "masks")
     EXPORT_DIR: str = os.path.join(ROOT_DIR, "exports")
+    EXPORT_WORKERS: int = int(os.getenv("NOTUM_EXPORT_WORKERS", "0"))  # Processes for VOC/YOLO/mask writing; 0 = all cores
+    EXPORT_BATCH_SIZE: int = 64  # Images per process-pool task
+    EXPORT_CHUNK_SIZE: int = 512  # Images read from the database per dimension lookup
+    EXPORT_PARALLEL_MIN_IMAGES: int = 200  # Below this, per-image formats are written inline
+    EXPORT_JOB_WORKERS: int = 1  # Export jobs run at the same time (each already uses EXPORT_WORKERS processes)
+    EXPORT_RESUME_JOBS: bool = os.getenv("NOTUM_EXPORT_RESUME", "1") == "1"  # Restart unfinished jobs on startup
+    EMBEDDING_STORE_DIR: str = os.path.join(ROOT_DIR, "embeddings")
 
     # AI Config
     MAX_IMAGE_SIZE: int = 1024
     DEVICE: str = "cuda"  # Will be auto-detected in service
 
+    # CPU performance profile (ignored on CUDA apart from COMPILE_IMAGE_ENCODER / WARMUP)
+    CPU_NUM_THREADS: int = int(os.getenv("NOTUM_CPU_THREADS", "0"))  # 0 = torch default (all physical cores)
+    CPU_INTEROP_THREADS: int = int(os.getenv("NOTUM_CPU_INTEROP_THREADS", "0"))
+    CPU_BF16_AUTOCAST: bool = os.getenv("NOTUM_CPU_BF16", "0") == "1"
+    CPU_CHANNELS_LAST: bool = os.getenv("NOTUM_CHANNELS_LAST", "0") == "1"
+    COMPILE_IMAGE_ENCODER: bool = os.getenv("NOTUM_COMPILE_ENCODER", "0") == "1"
+    WARMUP_ON_STARTUP: bool = os.getenv("NOTUM_WARMUP", "1") == "1"
+
+    EMBEDDING_CACHE_MAX_BYTES: int = 512 * 1024 * 1024  # In-memory LRU budget for image features
+    INFERENCE_WORKERS: int = 1  # Threads running image encodes off the event loop
+    INFERENCE_QUEUE_SIZE: int = 8  # Max queued + running encodes before /load_image_path pushes back
+    MAX_IMAGE_SESSIONS: int = 1000  # Image keys remembered for /segment lookups
+    PREFETCH_AHEAD: int = 3  # Images after the current one to pre-embed in the background
+    PREFETCH_BEHIND: int = 1
+    EMBEDDING_STORE_MAX_BYTES: int = 8 * 1024 * 1024 * 1024  # On-disk fp16 feature store budget
+    AUTO_SEGMENT_MAX_SECONDS: float = 20.0  # Default and maximum /auto_segment time budget
+    AUTO_SEGMENT_MAX_MASKS: int = 200  # Default and maximum /auto_segment proposal budget
+    AUTOSAVE_WINDOW_MS: int = 300  # How long /save_annotation writes are held to coalesce repeats
+    AUTOSAVE_MAX_PENDING: int = 64  # Pending images that force an early flush
+
 @lru_cache()
 def get_settings():
     return Settings()
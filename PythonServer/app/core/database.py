@@ -1,14 +1,58 @@
 import sqlite3
 import json
+import threading
 from app.core.config import get_settings
+from app.models.annotation import shape_to_row
 
 settings = get_settings()
 
-def get_db_connection():
-    conn = sqlite3.connect(settings.DB_PATH)
+# One connection per thread, reused across requests. sqlite3 caches prepared statements
+# per connection, so reuse also means statements are compiled once per thread.
+_local = threading.local()
+_all_connections = set()
+_pool_lock = threading.Lock()
+
+def _open_connection():
+    conn = sqlite3.connect(
+        settings.DB_PATH,
+        check_same_thread=False,  # Only used by its own thread, but closed from the shutdown hook
+        cached_statements=settings.DB_STATEMENT_CACHE_SIZE,
+        timeout=30,
+    )
     conn.row_factory = sqlite3.Row  # Return dict-like objects
+    # WAL lets readers proceed during autosaves; NORMAL skips the fsync per commit (still crash-safe in WAL)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={settings.DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def get_db_connection():
+    """
+    Return this thread's pooled connection. Use it as `with get_db_connection() as conn:`;
+    the context manager commits or rolls back but does not close the connection.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        with _pool_lock:
+            _all_connections.add(conn)
     return conn
 
+def close_all_connections():
+    """Close every pooled connection. Called at application shutdown."""
+    with _pool_lock:
+        conns = list(_all_connections)
+        _all_connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            print(f"Error closing database connection: {e}")
+    _local.__dict__.clear()
+
 def init_db():
     """Initialize the database schema."""
     with get_db_connection() as conn:
@@ -28,11 +72,266 @@ def init_db():
                         image_paths TEXT
                     )''')
 
-        # Annotations V2 (Scoped by project)
-        conn.execute('''CREATE TABLE IF NOT EXISTS annotations_v2 (
-                        project_id INTEGER,
-                        image_name TEXT,
-                        data TEXT,
+        # Annotation classes: stable integer ids for class names, per project
+        conn.execute('''CREATE TABLE IF NOT EXISTS annotation_classes (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_id INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        UNIQUE (project_id, name)
+                    )''')
+
+        # Annotation shapes: one row per polygon, points packed in a binary buffer
+        conn.execute('''CREATE TABLE IF NOT EXISTS annotation_shapes (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_id INTEGER NOT NULL,
+                        image_name TEXT NOT NULL,
+                        shape_index INTEGER NOT NULL,
+                        class_id INTEGER,
+                        x_min REAL, y_min REAL, x_max REAL, y_max REAL,
+                        area REAL,
+                        num_points INTEGER,
+                        points BLOB,
+                        point_dtype TEXT,
+                        extra TEXT
+                    )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_shapes_image
+                        ON annotation_shapes (project_id, image_name, shape_index)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_shapes_class
+                        ON annotation_shapes (project_id, class_id)''')
+
+        # Project images, one row each, in folder order. `annotated` is kept in sync by triggers
+        conn.execute('''CREATE TABLE IF NOT EXISTS images (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_id INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        path TEXT,
+                        position INTEGER NOT NULL,
+                        content_hash TEXT,
+                        annotated INTEGER NOT NULL DEFAULT 0,
+                        UNIQUE (project_id, name)
+                    )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_images_position ON images (project_id, position)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_images_path ON images (project_id, path)''')
+
+        # Header-probed image dimensions per file, valid while the file's mtime and size are unchanged
+        conn.execute('''CREATE TABLE IF NOT EXISTS image_dims (
+                        path TEXT PRIMARY KEY,
+                        mtime_ns INTEGER NOT NULL,
+                        size INTEGER NOT NULL,
+                        width INTEGER NOT NULL,
+                        height INTEGER NOT NULL
+                    )''')
+
+        # Background export jobs (see ExportJobService); rows outlive restarts so jobs can be resumed
+        conn.execute('''CREATE TABLE IF NOT EXISTS export_jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        project_id INTEGER NOT NULL,
+                        format TEXT NOT NULL,
+                        incremental INTEGER NOT NULL DEFAULT 0,
+                        status TEXT NOT NULL,
+                        done INTEGER NOT NULL DEFAULT 0,
+                        total INTEGER NOT NULL DEFAULT 0,
+                        path TEXT,
+                        error TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_export_jobs_project ON export_jobs (project_id, id)''')
+
+        # Incremental exports: one stable output directory per (project, format), and the
+        # annotation version and dims each image had when its output was last written
+        conn.execute('''CREATE TABLE IF NOT EXISTS export_targets (
+                        project_id INTEGER NOT NULL,
+                        format TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        categories_hash TEXT NOT NULL,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        PRIMARY KEY (project_id, format)
+                    )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS export_manifest (
+                        project_id INTEGER NOT NULL,
+                        format TEXT NOT NULL,
+                        image_name TEXT NOT NULL,
+                        version INTEGER NOT NULL,
+                        width INTEGER NOT NULL,
+                        height INTEGER NOT NULL,
+                        PRIMARY KEY (project_id, format, image_name)
+                    )''')
+
+        # Per-image annotation version, bumped on every save, for optimistic concurrency
+        conn.execute('''CREATE TABLE IF NOT EXISTS image_versions (
+                        project_id INTEGER NOT NULL,
+                        image_name TEXT NOT NULL,
+                        version INTEGER NOT NULL DEFAULT 0,
                         PRIMARY KEY (project_id, image_name)
                     )''')
+
+        # Project statistics, kept in sync with annotation_shapes by the triggers below
+        stats_exist = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'project_stats'").fetchone()
+        conn.execute('''CREATE TABLE IF NOT EXISTS project_stats (
+                        project_id INTEGER PRIMARY KEY,
+                        total_images INTEGER NOT NULL DEFAULT 0,
+                        annotated_images INTEGER NOT NULL DEFAULT 0,
+                        total_shapes INTEGER NOT NULL DEFAULT 0,
+                        total_area REAL NOT NULL DEFAULT 0
+                    )''')
+        # class_id 0 stands for shapes without a class
+        conn.execute('''CREATE TABLE IF NOT EXISTS project_class_stats (
+                        project_id INTEGER NOT NULL,
+                        class_id INTEGER NOT NULL,
+                        instance_count INTEGER NOT NULL DEFAULT 0,
+                        total_area REAL NOT NULL DEFAULT 0,
+                        PRIMARY KEY (project_id, class_id)
+                    )''')
+        _create_stats_triggers(conn)
+        _create_image_triggers(conn)
+
+        _migrate_annotations_v2(conn)
+        _migrate_image_paths(conn)
+        if not stats_exist:
+            rebuild_project_stats(conn)
         conn.commit()
+
+def _create_stats_triggers(conn):
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_shapes_stats_insert AFTER INSERT ON annotation_shapes BEGIN
+                        INSERT OR IGNORE INTO project_stats (project_id) VALUES (NEW.project_id);
+                        UPDATE project_stats SET
+                            total_shapes = total_shapes + 1,
+                            total_area = total_area + COALESCE(NEW.area, 0),
+                            annotated_images = annotated_images + ((
+                                SELECT COUNT(*) FROM annotation_shapes
+                                WHERE project_id = NEW.project_id AND image_name = NEW.image_name) = 1)
+                        WHERE project_id = NEW.project_id;
+                        INSERT INTO project_class_stats (project_id, class_id, instance_count, total_area)
+                        VALUES (NEW.project_id, COALESCE(NEW.class_id, 0), 1, COALESCE(NEW.area, 0))
+                        ON CONFLICT (project_id, class_id) DO UPDATE SET
+                            instance_count = instance_count + 1,
+                            total_area = total_area + excluded.total_area;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_shapes_stats_delete AFTER DELETE ON annotation_shapes BEGIN
+                        UPDATE project_stats SET
+                            total_shapes = total_shapes - 1,
+                            total_area = total_area - COALESCE(OLD.area, 0),
+                            annotated_images = annotated_images - ((
+                                SELECT COUNT(*) FROM annotation_shapes
+                                WHERE project_id = OLD.project_id AND image_name = OLD.image_name) = 0)
+                        WHERE project_id = OLD.project_id;
+                        UPDATE project_class_stats SET
+                            instance_count = instance_count - 1,
+                            total_area = total_area - COALESCE(OLD.area, 0)
+                        WHERE project_id = OLD.project_id AND class_id = COALESCE(OLD.class_id, 0);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_shapes_stats_update AFTER UPDATE OF class_id, area ON annotation_shapes BEGIN
+                        UPDATE project_stats SET
+                            total_area = total_area - COALESCE(OLD.area, 0) + COALESCE(NEW.area, 0)
+                        WHERE project_id = NEW.project_id;
+                        UPDATE project_class_stats SET
+                            instance_count = instance_count - 1,
+                            total_area = total_area - COALESCE(OLD.area, 0)
+                        WHERE project_id = OLD.project_id AND class_id = COALESCE(OLD.class_id, 0);
+                        INSERT INTO project_class_stats (project_id, class_id, instance_count, total_area)
+                        VALUES (NEW.project_id, COALESCE(NEW.class_id, 0), 1, COALESCE(NEW.area, 0))
+                        ON CONFLICT (project_id, class_id) DO UPDATE SET
+                            instance_count = instance_count + 1,
+                            total_area = total_area + excluded.total_area;
+                    END''')
+
+def _create_image_triggers(conn):
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_shapes_images_insert AFTER INSERT ON annotation_shapes BEGIN
+                        UPDATE images SET annotated = 1
+                        WHERE project_id = NEW.project_id AND name = NEW.image_name AND annotated = 0;
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_shapes_images_delete AFTER DELETE ON annotation_shapes BEGIN
+                        UPDATE images SET annotated = 0
+                        WHERE project_id = OLD.project_id AND name = OLD.image_name AND NOT EXISTS (
+                            SELECT 1 FROM annotation_shapes WHERE project_id = OLD.project_id AND image_name = OLD.image_name);
+                    END''')
+
+def rebuild_project_stats(conn):
+    """Recompute all project statistics from scratch (used when the stats tables are first created)."""
+    conn.execute("DELETE FROM project_class_stats")
+    conn.execute("DELETE FROM project_stats")
+    conn.execute('''INSERT INTO project_stats (project_id, total_images, annotated_images, total_shapes, total_area)
+                    SELECT p.project_id, 0,
+                           (SELECT COUNT(DISTINCT image_name) FROM annotation_shapes s WHERE s.project_id = p.project_id),
+                           (SELECT COUNT(*) FROM annotation_shapes s WHERE s.project_id = p.project_id),
+                           (SELECT COALESCE(SUM(area), 0) FROM annotation_shapes s WHERE s.project_id = p.project_id)
+                    FROM (SELECT DISTINCT project_id FROM annotation_shapes
+                          UNION SELECT project_id FROM project_state) p''')
+    conn.execute('''INSERT INTO project_class_stats (project_id, class_id, instance_count, total_area)
+                    SELECT project_id, COALESCE(class_id, 0), COUNT(*), COALESCE(SUM(area), 0)
+                    FROM annotation_shapes GROUP BY project_id, COALESCE(class_id, 0)''')
+    conn.execute('''UPDATE project_stats SET total_images =
+                    (SELECT COUNT(*) FROM images i WHERE i.project_id = project_stats.project_id)''')
+
+def get_class_id(conn, project_id: int, class_name):
+    """Return the id for a class name in a project, creating it on first use."""
+    if class_name is None:
+        return None
+    conn.execute("INSERT OR IGNORE INTO annotation_classes (project_id, name) VALUES (?, ?)", (project_id, class_name))
+    row = conn.execute("SELECT id FROM annotation_classes WHERE project_id = ? AND name = ?", (project_id, class_name)).fetchone()
+    return row[0]
+
+def update_shape(conn, shape_id: int, ann, shape_index: int = None) -> int:
+    """Overwrite a shape's content (and optionally its position). Returns the number of rows changed."""
+    row = shape_to_row(ann)
+    project_id = conn.execute("SELECT project_id FROM annotation_shapes WHERE id = ?", (shape_id,)).fetchone()
+    if project_id is None:
+        return 0
+    cursor = conn.execute(
+        '''UPDATE annotation_shapes SET shape_index = COALESCE(?, shape_index), class_id = ?,
+           x_min = ?, y_min = ?, x_max = ?, y_max = ?, area = ?, num_points = ?, points = ?, point_dtype = ?, extra = ?
+           WHERE id = ?''',
+        (shape_index, get_class_id(conn, project_id[0], row["class_name"]),
+         row["x_min"], row["y_min"], row["x_max"], row["y_max"], row["area"],
+         row["num_points"], row["points"], row["point_dtype"], row["extra"], shape_id))
+    return cursor.rowcount
+
+def insert_shape(conn, project_id: int, image_name: str, shape_index: int, ann) -> int:
+    row = shape_to_row(ann)
+    cursor = conn.execute(
+        '''INSERT INTO annotation_shapes
+           (project_id, image_name, shape_index, class_id, x_min, y_min, x_max, y_max,
+            area, num_points, points, point_dtype, extra)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        (project_id, image_name, shape_index, get_class_id(conn, project_id, row["class_name"]),
+         row["x_min"], row["y_min"], row["x_max"], row["y_max"],
+         row["area"], row["num_points"], row["points"], row["point_dtype"], row["extra"]))
+    return cursor.lastrowid
+
+def _migrate_annotations_v2(conn):
+    """Move per-image JSON blobs from annotations_v2 into annotation_shapes, keeping the old table as a backup."""
+    legacy = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'annotations_v2'").fetchone()
+    if not legacy:
+        return
+
+    print("Migrating annotations_v2 to annotation_shapes...")
+    migrated = 0
+    for project_id, image_name, data in conn.execute("SELECT project_id, image_name, data FROM annotations_v2").fetchall():
+        annotations = json.loads(data) if data else []
+        conn.execute("DELETE FROM annotation_shapes WHERE project_id = ? AND image_name = ?", (project_id, image_name))
+        # Every saved image, even one saved empty, has a version row; exports iterate those
+        conn.execute("INSERT OR IGNORE INTO image_versions (project_id, image_name, version) VALUES (?, ?, 1)",
+                     (project_id, image_name))
+        for idx, ann in enumerate(annotations or []):
+            insert_shape(conn, project_id, image_name, idx, ann)
+            migrated += 1
+    conn.execute("DROP TABLE IF EXISTS annotations_v2_migrated")
+    conn.execute("ALTER TABLE annotations_v2 RENAME TO annotations_v2_migrated")
+    print(f"Migrated {migrated} annotations.")
+
+def _migrate_image_paths(conn):
+    """Move the project_state.image_paths JSON dicts into the images table."""
+    rows = conn.execute("SELECT project_id, image_paths FROM project_state WHERE image_paths IS NOT NULL").fetchall()
+    if not rows:
+        return
+
+    print("Migrating project image lists to the images table...")
+    for project_id, image_paths in rows:
+        paths = json.loads(image_paths) or {}
+        conn.executemany(
+            '''INSERT OR IGNORE INTO images (project_id, name, path, position, annotated)
+               VALUES (?, ?, ?, ?, EXISTS (SELECT 1 FROM annotation_shapes WHERE project_id = ? AND image_name = ?))''',
+            [(project_id, name, path, pos, project_id, name) for pos, (name, path) in enumerate(paths.items())])
+        conn.execute("UPDATE project_state SET image_paths = NULL WHERE project_id = ?", (project_id,))
@@ -2,7 +2,10 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.api_routes import router
 from app.core.config import get_settings
-from app.core.database import init_db
+from app.core.database import init_db, close_all_connections
+from app.services.inference_executor import inference_executor
+from app.services.autosave_service import autosave_service
+from app.services.export_jobs import export_job_service
 
 settings = get_settings()
 
@@ -24,6 +27,14 @@ app.add_middleware(
 @app.on_event("startup")
 def on_startup():
     init_db()
+    export_job_service.recover()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    inference_executor.shutdown()
+    export_job_service.shutdown()
+    autosave_service.shutdown()  # Write buffered annotation saves before the connections close
+    close_all_connections()
 
 # Include Routes
 # We mount the router at root to maintain compatibility with existing frontend calls (which expect /projects, etc.)
@@ -0,0 +1,64 @@
+import json
+import numpy as np
+from typing import Dict, Any, List, Tuple
+
+# Keys stored in dedicated columns; everything else on a shape goes into the `extra` JSON column
+_COLUMN_KEYS = {"id", "points", "className"}
+
+POINTS_INT32 = "i4"
+POINTS_FLOAT64 = "f8"
+
+def encode_points(points: List[Dict[str, float]]) -> Tuple[bytes, str]:
+    """Pack [{"x", "y"}, ...] into a flat little-endian buffer. Integral coordinates use int32."""
+    if not points:
+        return b"", POINTS_INT32
+    arr = np.array([[p["x"], p["y"]] for p in points], dtype=np.float64)
+    if np.all(arr == np.round(arr)) and np.all(np.abs(arr) < 2**31):
+        return arr.astype("<i4").tobytes(), POINTS_INT32
+    return arr.astype("<f8").tobytes(), POINTS_FLOAT64
+
+def decode_points(buf: bytes, dtype: str) -> List[Dict[str, float]]:
+    if not buf:
+        return []
+    arr = np.frombuffer(buf, dtype="<" + dtype).reshape(-1, 2)
+    return [{"x": x, "y": y} for x, y in arr.tolist()]
+
+def polygon_area(points: List[Dict[str, float]]) -> float:
+    """Shoelace area, same result as cv2.contourArea for a simple polygon."""
+    if len(points) < 3:
+        return 0.0
+    xs = np.array([p["x"] for p in points], dtype=np.float64)
+    ys = np.array([p["y"] for p in points], dtype=np.float64)
+    return float(0.5 * abs(np.dot(xs, np.roll(ys, -1)) - np.dot(ys, np.roll(xs, -1))))
+
+def shape_to_row(ann: Dict[str, Any]) -> Dict[str, Any]:
+    """Column values for one frontend annotation dict (class id is resolved by the caller)."""
+    points = ann.get("points") or []
+    buf, dtype = encode_points(points)
+    if points:
+        xs = [p["x"] for p in points]
+        ys = [p["y"] for p in points]
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+    else:
+        bbox = (None, None, None, None)
+    extra = {k: v for k, v in ann.items() if k not in _COLUMN_KEYS}
+    return {
+        "class_name": ann.get("className"),
+        "x_min": bbox[0], "y_min": bbox[1], "x_max": bbox[2], "y_max": bbox[3],
+        "area": polygon_area(points),
+        "num_points": len(points),
+        "points": buf,
+        "point_dtype": dtype,
+        "extra": json.dumps(extra) if extra else None,
+    }
+
+def row_to_shape(points: bytes, point_dtype: str, class_name: str, extra: str, shape_id: int = None) -> Dict[str, Any]:
+    """Rebuild the frontend annotation dict from stored columns."""
+    ann = json.loads(extra) if extra else {}
+    if shape_id is not None:
+        ann["id"] = shape_id
+    ann["points"] = decode_points(points, point_dtype)
+    if class_name is not None:
+        # A shape saved without a class comes back without the key, as it was sent
+        ann["className"] = class_name
+    return ann
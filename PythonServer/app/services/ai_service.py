@@ -1,13 +1,30 @@
 import torch
 import numpy as np
-import cv2
 import os
+import copy
+import time
 import hashlib
-from typing import List, Dict, Any, Optional
+import threading
+import contextlib
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
 from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.utils.amg import rle_to_mask
 
 from app.core.config import get_settings
+from app.services.embedding_store import EmbeddingStore
+from app.services.inference_executor import inference_executor
+from app.services.mask_utils import masks_to_polygons
+from app.services.image_io import decode_for_model
+
+def _is_box(box) -> bool:
+    """True for an [x0, y0, x1, y1] list of four numbers."""
+    return (
+        isinstance(box, (list, tuple)) and len(box) == 4
+        and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in box)
+    )
 
 class AIService:
     _instance = None
@@ -23,86 +40,465 @@ class AIService:
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.checkpoint = settings.CHECKPOINT_PATH
         self.model_cfg = settings.MODEL_CONFIG_PATH
-        self.embedding_cache = {}
-        self.max_cache_size = 10
+        self.embedding_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.cache_bytes = 0
+        self.max_cache_bytes = settings.EMBEDDING_CACHE_MAX_BYTES
+        self.embedding_store = EmbeddingStore()
+        self.cache_lock = threading.RLock()
+        # Image key (resolved file path) -> {"hash", "path"}; features themselves live in the cache.
+        # Keyed by path only: file names repeat across projects and folders.
+        self.sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.max_sessions = settings.MAX_IMAGE_SESSIONS
+        # Encoder for interactive loads. Predictions never use its state directly; see _session_predictor
         self.predictor: Optional[SAM2ImagePredictor] = None
+        self.encode_lock = threading.Lock()
+        # Separate predictor state for background encodes so they never touch the interactive one
+        self.prefetch_predictor: Optional[SAM2ImagePredictor] = None
+        # Cleared while a foreground encode runs; background encodes wait on it
+        self.foreground_idle = threading.Event()
+        self.foreground_idle.set()
+        self.perf_profile = self._apply_perf_profile(settings)
         
         # Initialize
         print(f"Loading SAM2 model from {self.checkpoint} on {self.device}...")
         try:
-            sam2_model = build_sam2(self.model_cfg, self.checkpoint, device=self.device)
+            overrides = []
+            if settings.COMPILE_IMAGE_ENCODER:
+                overrides.append("++model.compile_image_encoder=True")  # Let sam2_base handle this
+            sam2_model = build_sam2(self.model_cfg, self.checkpoint, device=self.device, hydra_overrides_extra=overrides)
+            if self.perf_profile["channels_last"]:
+                sam2_model = sam2_model.to(memory_format=torch.channels_last)
             self.predictor = SAM2ImagePredictor(sam2_model)
+            self.prefetch_predictor = SAM2ImagePredictor(sam2_model)
             print("SAM2 Model loaded successfully.")
         except Exception as e:
             print(f"Failed to load SAM2 model: {e}")
 
+        if self.predictor and (settings.WARMUP_ON_STARTUP or settings.COMPILE_IMAGE_ENCODER):
+            self._warmup(settings.MAX_IMAGE_SIZE)
+
+    def _apply_perf_profile(self, settings) -> Dict[str, Any]:
+        """Apply thread settings and decide precision/layout options. Returns what was selected."""
+        on_cpu = self.device == "cpu"
+        if on_cpu and settings.CPU_NUM_THREADS > 0:
+            torch.set_num_threads(settings.CPU_NUM_THREADS)
+        if on_cpu and settings.CPU_INTEROP_THREADS > 0:
+            try:
+                torch.set_num_interop_threads(settings.CPU_INTEROP_THREADS)
+            except RuntimeError as e:  # Only allowed before any parallel work has started
+                print(f"Could not set interop threads: {e}")
+
+        profile = {
+            "device": self.device,
+            "num_threads": torch.get_num_threads(),
+            "interop_threads": torch.get_num_interop_threads(),
+            "bf16_autocast": on_cpu and settings.CPU_BF16_AUTOCAST,
+            "channels_last": on_cpu and settings.CPU_CHANNELS_LAST,
+            "compiled_encoder": settings.COMPILE_IMAGE_ENCODER,
+            "inference_mode": True,
+        }
+        print(f"Inference profile: {profile}")
+        return profile
+
+    def _inference_context(self):
+        """inference_mode for every model call, plus bf16 autocast when the CPU profile enables it."""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.perf_profile["bf16_autocast"]:
+            stack.enter_context(torch.autocast(device_type="cpu", dtype=torch.bfloat16))
+        return stack
+
+    @contextlib.contextmanager
+    def _foreground_encode(self):
+        """Hold the encoder for interactive backbone work; background encodes wait until it ends."""
+        with self.encode_lock:
+            self.foreground_idle.clear()
+            try:
+                yield
+            finally:
+                self.foreground_idle.set()
+
+    def _warmup(self, size: int):
+        """One encode + decode on a blank image so compilation and allocator warm-up happen at startup."""
+        print("Warming up SAM2 model...")
+        dummy = np.zeros((size, size, 3), dtype=np.uint8)
+        try:
+            with self._inference_context():
+                self.predictor.set_image(dummy)
+                self.predictor.predict(
+                    point_coords=np.array([[size // 2, size // 2]]),
+                    point_labels=np.array([1]),
+                    multimask_output=False,
+                )
+        except Exception as e:
+            print(f"Warm-up failed: {e}")
+        finally:
+            self.predictor.reset_predictor()
+
     def get_image_hash(self, image_bytes: bytes) -> str:
         return hashlib.md5(image_bytes).hexdigest()
 
-    def cache_embedding(self, img_hash: str, features, orig_hw):
-        """Limit cache size with LRU."""
-        if len(self.embedding_cache) >= self.max_cache_size:
-            oldest = next(iter(self.embedding_cache))
-            del self.embedding_cache[oldest]
-        self.embedding_cache[img_hash] = {"features": features, "orig_hw": orig_hw}
+    @staticmethod
+    def _features_nbytes(features) -> int:
+        tensors = [features["image_embed"], *features["high_res_feats"]]
+        return sum(t.element_size() * t.nelement() for t in tensors)
+
+    def get_cached_embedding(self, img_hash: str) -> Optional[Dict[str, Any]]:
+        """Return a cache entry and mark it as most recently used, falling back to the disk store."""
+        with self.cache_lock:
+            entry = self.embedding_cache.get(img_hash)
+            if entry is not None:
+                self.embedding_cache.move_to_end(img_hash)
+                return entry
+
+        stored = self.embedding_store.get(img_hash, self.device)
+        if stored is None:
+            return None
+        return self.cache_embedding(img_hash, stored["features"], stored["orig_hw"], stored["orig_size"], persist=False)
+
+    def has_embedding(self, img_hash: str) -> bool:
+        with self.cache_lock:
+            if img_hash in self.embedding_cache:
+                return True
+        return self.embedding_store.contains(img_hash)
+
+    def cache_embedding(self, img_hash: str, features, orig_hw, orig_size=None, persist=True):
+        """LRU cache bounded by the total size of the stored feature tensors."""
+        if persist and orig_size is not None:
+            self.embedding_store.put(img_hash, features, orig_hw, orig_size)
+
+        nbytes = self._features_nbytes(features)
+        entry = {
+            "features": features,
+            "orig_hw": orig_hw,
+            "orig_size": orig_size,
+            "nbytes": nbytes,
+        }
+        with self.cache_lock:
+            if img_hash in self.embedding_cache:
+                self.cache_bytes -= self.embedding_cache.pop(img_hash)["nbytes"]
+
+            while self.embedding_cache and self.cache_bytes + nbytes > self.max_cache_bytes:
+                _, evicted = self.embedding_cache.popitem(last=False)
+                self.cache_bytes -= evicted["nbytes"]
 
-    async def load_image_path(self, path: str) -> Dict[str, Any]:
-        """Load image from path, resize, cache embedding."""
+            self.embedding_cache[img_hash] = entry
+            self.cache_bytes += nbytes
+        return entry
+
+    @staticmethod
+    def image_key_for(path: str) -> str:
+        return os.path.realpath(path)
+
+    def _register_session(self, key: str, img_hash: str, path: str):
+        session = {"hash": img_hash, "path": path, "prev_prompt": None, "prev_logits": None}
+        with self.cache_lock:
+            existing = self.sessions.pop(key, None)
+            if existing and existing["hash"] == img_hash:
+                session = existing  # Same file reloaded: keep its refinement state
+            self.sessions[key] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def _session_predictor(self, entry: Dict[str, Any]) -> SAM2ImagePredictor:
+        """
+        A predictor bound to one image's cached features. Shallow copy shares the model
+        and transforms with the encoder, so this costs no backbone pass and no allocation.
+        """
+        predictor = copy.copy(self.predictor)
+        predictor._features = entry["features"]
+        predictor._orig_hw = entry["orig_hw"]
+        predictor._is_image_set = True
+        predictor._is_batch = False
+        return predictor
+
+    def _read_image(self, path: str) -> Tuple[bytes, str]:
         if not os.path.exists(path):
             raise FileNotFoundError(f"Image not found at {path}")
-            
-        settings = get_settings()
-        
         with open(path, "rb") as f:
             image_bytes = f.read()
+        return image_bytes, self.get_image_hash(image_bytes)
 
-        img_hash = self.get_image_hash(image_bytes)
-        
-        # Check cache (disabled temporarily as per original logic if needed, but here we can try enabling if stable)
-        # For now, let's keep the caching explicit logic from main.py but wrapped in service
-        
-        np_img = np.frombuffer(image_bytes, np.uint8)
-        image = cv2.imdecode(np_img, cv2.IMREAD_COLOR)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        h, w = image.shape[:2]
-        
-        if max(h, w) > settings.MAX_IMAGE_SIZE:
-            scale = settings.MAX_IMAGE_SIZE / max(h, w)
-            image = cv2.resize(image, (int(w * scale), int(h * scale)))
-            
-        if self.predictor:
-            self.predictor.set_image(image)
-            self.cache_embedding(img_hash, self.predictor._features, self.predictor._orig_hw)
-            
-        return {"message": "Image encoded", "width": w, "height": h}
-
-    def segment(self, points: List[Dict[str, int]]) -> Dict[str, Any]:
-        if not points:
+    def _decode_image(self, image_bytes: bytes):
+        """Decode to RGB and downsize to MAX_IMAGE_SIZE. Returns the image and original (w, h)."""
+        settings = get_settings()
+        return decode_for_model(image_bytes, settings.MAX_IMAGE_SIZE)
+
+    def _encode(self, image_bytes: bytes, img_hash: str) -> Dict[str, Any]:
+        """Run the backbone for an image and store the result in the embedding cache."""
+        image, size = self._decode_image(image_bytes)
+        with self._foreground_encode():
+            with self._inference_context():
+                self.predictor.set_image(image)
+            features, orig_hw = self.predictor._features, self.predictor._orig_hw
+            self.predictor.reset_predictor()
+        return self.cache_embedding(img_hash, features, orig_hw, size)
+
+    def load_image_path(self, path: str) -> Dict[str, Any]:
+        """
+        Load image from path, resize, cache embedding. Blocking: run via the inference executor.
+        The returned image_key is what /segment, /segment_batch and /auto_segment expect.
+        """
+        if not self.predictor:
+            raise RuntimeError("SAM2 model is not loaded")
+
+        image_bytes, img_hash = self._read_image(path)
+
+        entry = self.get_cached_embedding(img_hash)
+        cached = entry is not None
+        if not cached:
+            entry = self._encode(image_bytes, img_hash)
+
+        image_key = self.image_key_for(path)
+        self._register_session(image_key, img_hash, path)
+
+        w, h = entry["orig_size"]
+        message = "Image loaded from cache" if cached else "Image encoded"
+        return {"message": message, "width": w, "height": h, "cached": cached, "image_key": image_key, "content_hash": img_hash}
+
+    def _get_session_entry(self, image_key: Optional[str]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Find the session and features for an image key, re-encoding from its path if they were evicted."""
+        if not image_key:
+            return None, None
+        with self.cache_lock:
+            session = self.sessions.get(image_key)
+            if session:
+                self.sessions.move_to_end(image_key)
+        if not session:
+            return None, None
+
+        entry = self.get_cached_embedding(session["hash"])
+        if entry is None:
+            image_bytes, img_hash = self._read_image(session["path"])
+            entry = self._encode(image_bytes, img_hash)
+            if img_hash != session["hash"]:
+                session.update(hash=img_hash, prev_prompt=None, prev_logits=None)
+        return session, entry
+
+    def prefetch_path(self, path: str, is_cancelled: Callable[[], bool]) -> bool:
+        """
+        Encode an image into the embedding cache from a background thread.
+        Returns True if a backbone pass was run, False if skipped or cancelled.
+        """
+        if not self.prefetch_predictor:
+            return False
+        image_bytes, img_hash = self._read_image(path)
+        if self.has_embedding(img_hash) or is_cancelled():
+            return False
+
+        image, size = self._decode_image(image_bytes)
+        # Yield to interactive encodes: they own the cores while they run
+        self.foreground_idle.wait()
+        if is_cancelled():
+            return False
+
+        with self._inference_context():
+            self.prefetch_predictor.set_image(image)
+        features, orig_hw = self.prefetch_predictor._features, self.prefetch_predictor._orig_hw
+        self.prefetch_predictor.reset_predictor()
+        self.cache_embedding(img_hash, features, orig_hw, size)
+        return True
+
+    def segment(
+        self,
+        points: List[Dict[str, int]],
+        image_key: Optional[str] = None,
+        labels: Optional[List[int]] = None,
+        box: Optional[List[float]] = None,
+        reset: bool = False,
+        multi_component: bool = False,
+        with_holes: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Interactive click-to-segment. Labels default to each point's "label" key, else 1 (foreground).
+        When the prompt extends the previous one for the same image, the previous low-res logits are
+        fed back as mask_input, as SAM2ImagePredictor.predict expects for iterative refinement.
+        Raises ValueError when labels do not match the points or the box is not four numbers.
+        """
+        points = points or []
+        if not points and not box:
             return {"polygon": [], "error": "No points provided"}
-            
-        if not self.predictor or not getattr(self.predictor, "_is_image_set", False):
+        if labels is not None and len(labels) != len(points):
+            raise ValueError(f"{len(labels)} labels for {len(points)} points")
+        if box and not _is_box(box):
+            raise ValueError("box must be [x0, y0, x1, y1]")
+
+        session, entry = self._get_session_entry(image_key) if self.predictor else (None, None)
+        if entry is None:
              return {"polygon": [], "error": "Image not set in predictor"}
+        predictor = self._session_predictor(entry)
+
+        if labels is None:
+            labels = [int(p.get("label", 1)) for p in points]
+        prompt = (tuple(box) if box else None, tuple((p["x"], p["y"], l) for p, l in zip(points, labels)))
+
+        mask_input = None
+        prev_prompt = session["prev_prompt"]
+        if not reset and prev_prompt is not None:
+            prev_box, prev_points = prev_prompt
+            extends_previous = (
+                prev_box == prompt[0]
+                and len(prev_points) < len(prompt[1])
+                and prompt[1][:len(prev_points)] == prev_points
+            )
+            if extends_previous:
+                mask_input = session["prev_logits"]
+
+        input_points = np.array([[p["x"], p["y"]] for p in points]) if points else None
+        input_labels = np.array(labels) if points else None
+
+        # Same steps as predictor.predict, minus the full-resolution copy to host memory:
+        # masks stay thresholded on the device and only their ROI is transferred for contouring
+        with self._inference_context():
+            mask_t, coords_t, labels_t, box_t = predictor._prep_prompts(
+                input_points, input_labels, np.array(box) if box else None, mask_input, normalize_coords=True
+            )
+            masks, scores, low_res_masks = predictor._predict(
+                coords_t, labels_t, box_t, mask_t, multimask_output=False
+            )
+        session["prev_prompt"] = prompt
+        session["prev_logits"] = low_res_masks[0, 0:1].float().cpu().numpy()
+
+        components = masks_to_polygons(masks[:, 0], multi_component, with_holes)[0]
+        result = {
+            "polygon": components[0]["points"] if components else [],
+            "score": float(scores[0, 0]),
+            "refined": mask_input is not None,
+        }
+        if multi_component or with_holes:
+            result["components"] = components
+        return result
+
+    def segment_batch(self, prompts: List[Dict[str, Any]], image_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Decode many prompts against one image in a single mask-decoder call.
+        Each prompt may carry "points" (with optional "labels") and/or a "box" [x0, y0, x1, y1].
+        Prompts with fewer points are padded with label -1 (the prompt encoder's not-a-point token).
+        Raises ValueError for malformed prompts.
+        """
+        if not prompts:
+            raise ValueError("No prompts provided")
+        for i, p in enumerate(prompts):
+            if not p.get("points") and not p.get("box"):
+                raise ValueError(f"Prompt {i} has no points or box")
+            labels = p.get("labels")
+            if labels is not None and len(labels) != len(p.get("points") or []):
+                raise ValueError(f"Prompt {i} has {len(labels)} labels for {len(p.get('points') or [])} points")
+            if p.get("box") and not _is_box(p["box"]):
+                raise ValueError(f"Prompt {i} box must be [x0, y0, x1, y1]")
 
-        input_points = np.array([[p["x"], p["y"]] for p in points])
-        input_labels = np.array([1] * len(points)) # 1 = foreground
+        _, entry = self._get_session_entry(image_key) if self.predictor else (None, None)
+        if entry is None:
+            return {"results": [], "error": "Image not set in predictor"}
+        predictor = self._session_predictor(entry)
 
-        masks, scores, _ = self.predictor.predict(
-            point_coords=input_points,
-            point_labels=input_labels,
-            multimask_output=False
+        has_box = any(p.get("box") for p in prompts)
+        box_slots = 2 if has_box else 0
+        max_points = max(len(p.get("points") or []) for p in prompts)
+        coords = np.zeros((len(prompts), box_slots + max_points, 2), dtype=np.float32)
+        labels = -np.ones((len(prompts), box_slots + max_points), dtype=np.int32)
+
+        for i, p in enumerate(prompts):
+            box = p.get("box")
+            if box:
+                coords[i, 0:2] = [[box[0], box[1]], [box[2], box[3]]]
+                labels[i, 0:2] = [2, 3]  # Box corners, same encoding _predict uses for boxes
+            points = p.get("points") or []
+            point_labels = p.get("labels") or [1] * len(points)
+            for j, (pt, lbl) in enumerate(zip(points, point_labels)):
+                coords[i, box_slots + j] = [pt["x"], pt["y"]]
+                labels[i, box_slots + j] = lbl
+
+        coords_t = torch.as_tensor(coords, device=predictor.device)
+        coords_t = predictor._transforms.transform_coords(coords_t, normalize=True, orig_hw=entry["orig_hw"][0])
+        labels_t = torch.as_tensor(labels, device=predictor.device)
+
+        with self._inference_context():
+            masks, scores, _ = predictor._predict(coords_t, labels_t, multimask_output=False)
+        scores_np = scores[:, 0].float().cpu().numpy()
+
+        results = [
+            {"polygon": components[0]["points"] if components else [], "score": float(score)}
+            for components, score in zip(masks_to_polygons(masks[:, 0]), scores_np)
+        ]
+        return {"results": results}
+
+    def auto_segment(
+        self,
+        image_key: Optional[str] = None,
+        points_per_side: int = 32,
+        pred_iou_thresh: float = 0.8,
+        stability_score_thresh: float = 0.95,
+        crop_n_layers: int = 0,
+        low_res_filter: bool = True,
+        max_seconds: Optional[float] = None,
+        max_masks: Optional[int] = None,
+        multi_component: bool = False,
+        with_holes: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Automatic mask proposals for a loaded image, yielded one by one as each decoder batch passes
+        filtering. The uncropped layer decodes against the cached features, so with crop_n_layers=0
+        this is one decoder sweep over the point grid and no backbone pass. Stops when max_seconds
+        or max_masks is reached. Coordinates are in the same frame as /segment. With low_res_filter,
+        proposals are scored on the 256x256 logits and only survivors are upsampled.
+        """
+        session, entry = self._get_session_entry(image_key) if self.predictor else (None, None)
+        if entry is None:
+            yield {"error": "Image not set in predictor"}
+            return
+
+        generator = SAM2AutomaticMaskGenerator(
+            self.predictor.model,
+            points_per_side=points_per_side,
+            pred_iou_thresh=pred_iou_thresh,
+            stability_score_thresh=stability_score_thresh,
+            crop_n_layers=crop_n_layers,
+            output_mode="uncompressed_rle",
+            low_res_filter=low_res_filter,
         )
-        
-        mask_bin = (masks[0] * 255).astype(np.uint8)
-        contours, _ = cv2.findContours(mask_bin, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        polygon = []
-        if contours:
-            main_contour = max(contours, key=cv2.contourArea)
-            epsilon = 0.002 * cv2.arcLength(main_contour, True)
-            approx = cv2.approxPolyDP(main_contour, epsilon, True)
-            polygon = [{"x": int(p[0][0]), "y": int(p[0][1])} for p in approx]
-            
-        return {"polygon": polygon, "score": float(scores[0])}
-        
+        generator.set_image_features(entry["features"], entry["orig_hw"][0])
+        image = None
+        if crop_n_layers > 0:  # Crops are embedded from pixels at the same scale as the cached features
+            image, _ = self._decode_image(self._read_image(session["path"])[0])
+
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        stream = generator.generate_stream(image, deadline=deadline, max_masks=max_masks)
+
+        def step():
+            # Entered per step: the consumer may advance the stream from a different thread each time
+            with self._inference_context():
+                return next(stream, None)
+
+        def encode_step():
+            with self._foreground_encode():
+                return step()
+
+        while True:
+            if crop_n_layers > 0:
+                # Crop layers run the backbone, so they go through the inference pool and the
+                # encoder lock like image loads, and background encodes pause meanwhile
+                data = inference_executor.executor.submit(encode_step).result()
+            else:
+                data = step()
+            if data is None:
+                break
+            for rle, score, stability, box, point in zip(
+                data["rles"], data["iou_preds"], data["stability_score"], data["boxes"], data["points"]
+            ):
+                mask = torch.from_numpy(rle_to_mask(rle))[None]
+                components = masks_to_polygons(mask, multi_component, with_holes)[0]
+                if not components:
+                    continue
+                proposal = {
+                    "polygon": components[0]["points"],
+                    "score": float(score),
+                    "stability": float(stability),
+                    "box": [int(v) for v in box],
+                    "point": {"x": float(point[0]), "y": float(point[1])},
+                }
+                if multi_component or with_holes:
+                    proposal["components"] = components
+                yield proposal
+
 ai_service = AIService()
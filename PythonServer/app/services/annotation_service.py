@@ -0,0 +1,200 @@
+from itertools import groupby
+from typing import Dict, Any, List, Iterator, Tuple
+
+from app.core.database import get_db_connection, get_class_id, insert_shape, update_shape
+from app.models.annotation import shape_to_row, row_to_shape
+
+class AnnotationService:
+    """Reads and writes annotations as per-shape rows in annotation_shapes."""
+
+    def load_annotations(self, project_id: int, image_name: str) -> Tuple[List[Dict[str, Any]], int]:
+        """Return the image's shapes (each carrying its row "id") and the image's annotation version."""
+        with get_db_connection() as conn:
+            cursor = conn.execute(
+                '''SELECT s.points, s.point_dtype, c.name, s.extra, s.id
+                   FROM annotation_shapes s LEFT JOIN annotation_classes c ON c.id = s.class_id
+                   WHERE s.project_id = ? AND s.image_name = ?
+                   ORDER BY s.shape_index''', (project_id, image_name))
+            shapes = [row_to_shape(*row) for row in cursor.fetchall()]
+            return shapes, self.get_version(conn, project_id, image_name)
+
+    def get_version(self, conn, project_id: int, image_name: str) -> int:
+        row = conn.execute(
+            "SELECT version FROM image_versions WHERE project_id = ? AND image_name = ?", (project_id, image_name)).fetchone()
+        return row[0] if row else 0
+
+    def _bump_version(self, conn, project_id: int, image_name: str, expected: int = None) -> int:
+        """
+        Increment the image version and return the new value. With `expected`, this is a
+        compare-and-swap: returns -1 without writing if the stored version differs.
+        """
+        if expected is None:
+            conn.execute("INSERT OR IGNORE INTO image_versions (project_id, image_name) VALUES (?, ?)", (project_id, image_name))
+            conn.execute("UPDATE image_versions SET version = version + 1 WHERE project_id = ? AND image_name = ?",
+                         (project_id, image_name))
+            return self.get_version(conn, project_id, image_name)
+
+        cursor = conn.execute(
+            "UPDATE image_versions SET version = version + 1 WHERE project_id = ? AND image_name = ? AND version = ?",
+            (project_id, image_name, expected))
+        if cursor.rowcount == 0:
+            if expected != 0:
+                return -1
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO image_versions (project_id, image_name, version) VALUES (?, ?, 1)",
+                (project_id, image_name))
+            if cursor.rowcount == 0:
+                return -1
+        return expected + 1
+
+    def save_annotations(self, project_id: int, image_name: str, annotations: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Store the full annotation list for an image, touching only the shape rows that changed.
+        Rows are matched to the list by position. Returns the row counts, the shape ids in list
+        order and the new image version.
+        """
+        with get_db_connection() as conn:
+            result = self.write_annotations(conn, project_id, image_name, annotations)
+            conn.commit()
+        return result
+
+    def write_annotations(self, conn, project_id: int, image_name: str, annotations: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """save_annotations on the caller's connection, without committing."""
+        annotations = annotations or []
+        counts = {"inserted": 0, "updated": 0, "deleted": 0}
+        ids = []
+        existing = conn.execute(
+            '''SELECT id, shape_index, class_id, points, point_dtype, extra FROM annotation_shapes
+               WHERE project_id = ? AND image_name = ? ORDER BY shape_index''',
+            (project_id, image_name)).fetchall()
+
+        for idx, ann in enumerate(annotations):
+            if idx >= len(existing):
+                ids.append(insert_shape(conn, project_id, image_name, idx, ann))
+                counts["inserted"] += 1
+                continue
+
+            current = existing[idx]
+            ids.append(current["id"])
+            row = shape_to_row(ann)
+            unchanged = (
+                current["shape_index"] == idx
+                and current["class_id"] == get_class_id(conn, project_id, row["class_name"])
+                and current["points"] == row["points"]
+                and current["point_dtype"] == row["point_dtype"]
+                and current["extra"] == row["extra"]
+            )
+            if not unchanged:
+                update_shape(conn, current["id"], ann, shape_index=idx)
+                counts["updated"] += 1
+
+        stale = [r["id"] for r in existing[len(annotations):]]
+        if stale:
+            conn.executemany("DELETE FROM annotation_shapes WHERE id = ?", [(i,) for i in stale])
+            counts["deleted"] = len(stale)
+        # The version tracks content, so a save that changed nothing keeps it (incremental exports rely on this).
+        # The first save always gets one, even when empty: exports cover every saved image
+        version = self.get_version(conn, project_id, image_name)
+        if any(counts.values()) or version == 0:
+            version = self._bump_version(conn, project_id, image_name)
+        return {"changes": counts, "ids": ids, "version": version}
+
+    def apply_delta(
+        self,
+        project_id: int,
+        image_name: str,
+        base_version: int,
+        added: List[Dict[str, Any]] = None,
+        modified: List[Dict[str, Any]] = None,
+        deleted: List[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Patch an image's shapes: append `added`, overwrite `modified` (matched by "id") and remove
+        `deleted` ids. Rejected without any write if base_version is not the stored version.
+        """
+        added, modified, deleted = added or [], modified or [], deleted or []
+        with get_db_connection() as conn:
+            # Version check first: the CAS update takes SQLite's write lock for the whole patch
+            version = self._bump_version(conn, project_id, image_name, expected=base_version)
+            if version < 0:
+                current = self.get_version(conn, project_id, image_name)
+                conn.rollback()
+                return {"error": "Stale annotation version", "conflict": True, "version": current}
+
+            owned = {r[0] for r in conn.execute(
+                "SELECT id FROM annotation_shapes WHERE project_id = ? AND image_name = ?", (project_id, image_name))}
+            unknown = [a.get("id") for a in modified if a.get("id") not in owned] + [i for i in deleted if i not in owned]
+            if unknown:
+                conn.rollback()
+                return {"error": f"Unknown shape ids: {unknown}", "version": base_version}
+
+            for ann in modified:
+                update_shape(conn, ann["id"], ann)
+            if deleted:
+                conn.executemany("DELETE FROM annotation_shapes WHERE id = ?", [(i,) for i in deleted])
+
+            next_index = conn.execute(
+                "SELECT COALESCE(MAX(shape_index), -1) + 1 FROM annotation_shapes WHERE project_id = ? AND image_name = ?",
+                (project_id, image_name)).fetchone()[0]
+            added_ids = [insert_shape(conn, project_id, image_name, next_index + i, ann) for i, ann in enumerate(added)]
+            conn.commit()
+        return {"status": "success", "version": version, "added_ids": added_ids}
+
+    def versions(self, conn, project_id: int) -> Dict[str, int]:
+        """{image_name: version} for every image in the project that has been saved."""
+        cursor = conn.execute("SELECT image_name, version FROM image_versions WHERE project_id = ?", (project_id,))
+        return {name: version for name, version in cursor}
+
+    def delete_project(self, conn, project_id: int):
+        conn.execute("DELETE FROM annotation_shapes WHERE project_id = ?", (project_id,))
+        conn.execute("DELETE FROM annotation_classes WHERE project_id = ?", (project_id,))
+        conn.execute("DELETE FROM image_versions WHERE project_id = ?", (project_id,))
+        conn.execute("DELETE FROM project_class_stats WHERE project_id = ?", (project_id,))
+        conn.execute("DELETE FROM project_stats WHERE project_id = ?", (project_id,))
+
+    def set_total_images(self, conn, project_id: int, total_images: int):
+        conn.execute("INSERT OR IGNORE INTO project_stats (project_id) VALUES (?)", (project_id,))
+        conn.execute("UPDATE project_stats SET total_images = ? WHERE project_id = ?", (total_images, project_id))
+
+    def project_stats(self, conn, project_id: int) -> Dict[str, Any]:
+        """Counters maintained by the annotation_shapes triggers; cost does not depend on project size."""
+        row = conn.execute(
+            "SELECT total_images, annotated_images, total_shapes, total_area FROM project_stats WHERE project_id = ?",
+            (project_id,)).fetchone()
+        cursor = conn.execute(
+            '''SELECT COALESCE(c.name, 'Unknown'), cs.instance_count, cs.total_area
+               FROM project_class_stats cs LEFT JOIN annotation_classes c ON c.id = cs.class_id
+               WHERE cs.project_id = ? AND cs.instance_count > 0''', (project_id,))
+        class_dist, class_area = {}, {}
+        for name, count, area in cursor.fetchall():
+            class_dist[name] = class_dist.get(name, 0) + count
+            class_area[name] = class_area.get(name, 0.0) + area
+        return {
+            "total_images": row[0] if row else 0,
+            "annotated_count": row[1] if row else 0,
+            "total_shapes": row[2] if row else 0,
+            "total_area": row[3] if row else 0.0,
+            "class_distribution": class_dist,
+            "class_area": class_area,
+        }
+
+    def iter_project_annotations(self, conn, project_id: int) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        """
+        Yield (image_name, annotations) for every saved image, in image name order. Images saved
+        with an empty list have a version but no shape rows; they are yielded with no annotations.
+        """
+        cursor = conn.execute(
+            '''SELECT v.image_name, s.points, s.point_dtype, c.name, s.extra
+               FROM image_versions v
+               LEFT JOIN annotation_shapes s ON s.project_id = v.project_id AND s.image_name = v.image_name
+               LEFT JOIN annotation_classes c ON c.id = s.class_id
+               WHERE v.project_id = ?
+               ORDER BY v.image_name, s.shape_index''', (project_id,))
+        for image_name, rows in groupby(cursor, key=lambda r: r[0]):
+            yield image_name, [row_to_shape(*r[1:]) for r in rows if r[1] is not None]
+
+    def count_saved_images(self, conn, project_id: int) -> int:
+        """Number of images iter_project_annotations yields."""
+        return conn.execute("SELECT COUNT(*) FROM image_versions WHERE project_id = ?", (project_id,)).fetchone()[0]
+
+annotation_service = AnnotationService()
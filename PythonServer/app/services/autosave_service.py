@@ -0,0 +1,194 @@
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.config import get_settings
+from app.core.database import get_db_connection
+from app.models.annotation import shape_to_row
+from app.services.annotation_service import annotation_service
+
+Key = Tuple[int, str]
+
+class AutosaveService:
+    """
+    Write-behind buffer for full annotation saves.
+
+    Saves are held per (project_id, image_name) for up to AUTOSAVE_WINDOW_MS; a newer save for
+    the same image replaces the pending one, so a burst of edits becomes a single write. Due
+    saves are flushed together in one transaction by a background thread, each image under
+    its own savepoint so one bad save is dropped without losing the rest. Readers that need
+    to see the latest state call flush() first, and shutdown() drains whatever is left.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()  # Serializes the background flush with on-demand flushes
+        # key -> (annotations, time of the first save since the last flush)
+        self.pending: Dict[Key, Tuple[List[Dict[str, Any]], float]] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = False
+        self.metrics = {
+            "saves": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "images_written": 0,
+            "errors": 0,
+            "dropped": 0,
+            "last_error": None,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="annotation-autosave", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, project_id: int, image_name: str, annotations: List[Dict[str, Any]]):
+        """Queue a full save. Raises ValueError for a payload that could never be written."""
+        if project_id is None or not image_name:
+            raise ValueError("project_id and image_name are required")
+        if annotations is not None and not isinstance(annotations, list):
+            raise ValueError("annotations must be a list")
+        for ann in annotations or []:
+            if not isinstance(ann, dict):
+                raise ValueError("each annotation must be an object")
+            try:
+                shape_to_row(ann)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"invalid annotation: {e!r}") from e
+        key = (project_id, image_name)
+        with self.condition:
+            previous = self.pending.get(key)
+            if previous is not None:
+                self.metrics["coalesced"] += 1
+            # Keep the original timestamp so a steady stream of edits still flushes within the window
+            first_seen = previous[1] if previous is not None else time.monotonic()
+            self.pending[key] = (annotations or [], first_seen)
+            self.metrics["saves"] += 1
+            self.condition.notify()
+        self.start()
+
+    def discard(self, project_id: int):
+        """Drop pending saves for a project that is being deleted."""
+        with self.condition:
+            for key in [k for k in self.pending if k[0] == project_id]:
+                del self.pending[key]
+
+    def flush(self, project_id: Optional[int] = None, image_name: Optional[str] = None) -> int:
+        """
+        Write pending saves now, on the calling thread. Limited to one project, or one image,
+        when given. Also waits out a background flush in progress, so callers read committed
+        rows afterwards. Never raises: failures are logged and counted in stats(). Returns the
+        number of images written.
+        """
+        with self.flush_lock:
+            with self.condition:
+                keys = [
+                    k for k in self.pending
+                    if (project_id is None or k[0] == project_id) and (image_name is None or k[1] == image_name)
+                ]
+            return self._write_batch(keys) or 0
+
+    def _write_batch(self, keys: List[Key]) -> Optional[int]:
+        """
+        Write the given pending keys in one transaction, each image under its own savepoint.
+        An image whose payload fails to write is rolled back and dropped. Database errors
+        (e.g. a lock timeout) requeue the whole batch and return None. Caller holds flush_lock.
+        """
+        with self.condition:
+            batch = {k: self.pending.pop(k) for k in keys if k in self.pending}
+        if not batch:
+            return 0
+
+        start = time.perf_counter()
+        written = 0
+        conn = get_db_connection()
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                for (project_id, image_name), (annotations, _) in batch.items():
+                    conn.execute("SAVEPOINT autosave_image")
+                    try:
+                        annotation_service.write_annotations(conn, project_id, image_name, annotations)
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO autosave_image")
+                        self._record_error(f"Autosave dropped {image_name} (project {project_id}): {e}", dropped=1)
+                    else:
+                        written += 1
+                    finally:
+                        conn.execute("RELEASE autosave_image")
+        except Exception as e:
+            self._record_error(f"Autosave flush failed ({len(batch)} images), will retry: {e}")
+            with self.condition:
+                # Put the batch back unless a newer save for the same image arrived meanwhile
+                for key, entry in batch.items():
+                    self.pending.setdefault(key, entry)
+            return None
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self.condition:
+            self.metrics["flushes"] += 1
+            self.metrics["images_written"] += written
+            self.metrics["last_flush_ms"] = elapsed_ms
+            self.metrics["max_flush_ms"] = max(self.metrics["max_flush_ms"], elapsed_ms)
+            self.metrics["total_flush_ms"] += elapsed_ms
+        return written
+
+    def _record_error(self, message: str, dropped: int = 0):
+        print(message)
+        with self.condition:
+            self.metrics["errors"] += 1
+            self.metrics["dropped"] += dropped
+            self.metrics["last_error"] = message
+
+    def _run(self):
+        window = self.settings.AUTOSAVE_WINDOW_MS / 1000
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                now = time.monotonic()
+                oldest = min(first_seen for _, first_seen in self.pending.values())
+                if now - oldest < window and len(self.pending) < self.settings.AUTOSAVE_MAX_PENDING:
+                    self.condition.wait(window - (now - oldest))
+                    continue
+                # Once the oldest save is due, take everything: one commit for the whole burst
+                due = list(self.pending)
+
+            with self.flush_lock:
+                written = self._write_batch(due)
+            if written is None:
+                # The batch was requeued; back off for one window before retrying
+                time.sleep(window)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            now = time.monotonic()
+            flushes = self.metrics["flushes"]
+            return {
+                **self.metrics,
+                "queue_depth": len(self.pending),
+                "oldest_pending_ms": max(((now - t) * 1000 for _, t in self.pending.values()), default=0.0),
+                "avg_flush_ms": self.metrics["total_flush_ms"] / flushes if flushes else 0.0,
+            }
+
+    def shutdown(self):
+        """Stop the flush thread and write everything still pending."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.flush()
+
+autosave_service = AutosaveService()
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+import torch
+from typing import Dict, Any, Optional
+
+from app.core.config import get_settings
+
+class EmbeddingStore:
+    """
+    Disk tier behind AIService.embedding_cache.
+
+    Each entry is a flat fp16 feature file (<key>.bin) plus a JSON sidecar (<key>.json)
+    holding tensor shapes and image sizes. The sidecar is written last, so an entry
+    only becomes visible once its feature file is complete. Reads go through np.memmap.
+    """
+
+    def __init__(self):
+        settings = get_settings()
+        self.store_dir = settings.EMBEDDING_STORE_DIR
+        self.max_bytes = settings.EMBEDDING_STORE_MAX_BYTES
+        # Model identity is part of the key: features from another checkpoint or input size are useless
+        model_id = "|".join([
+            os.path.basename(settings.MODEL_CONFIG_PATH),
+            os.path.basename(settings.CHECKPOINT_PATH),
+            str(settings.MAX_IMAGE_SIZE),
+        ])
+        self.model_tag = hashlib.md5(model_id.encode("utf-8")).hexdigest()[:12]
+        self.lock = threading.Lock()
+        self.index: Dict[str, Dict[str, Any]] = {}  # key -> {"nbytes", "atime"}
+        self.total_bytes = 0
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Rebuild the LRU index from the files already on disk."""
+        for name in os.listdir(self.store_dir):
+            if name.endswith(".tmp"):
+                # Left behind by a write that was interrupted
+                os.remove(os.path.join(self.store_dir, name))
+                continue
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            bin_path, meta_path = self._paths(key)
+            if not os.path.exists(bin_path):
+                os.remove(meta_path)
+                continue
+            nbytes = os.path.getsize(bin_path) + os.path.getsize(meta_path)
+            self.index[key] = {"nbytes": nbytes, "atime": os.path.getmtime(meta_path)}
+            self.total_bytes += nbytes
+
+    def _key(self, img_hash: str) -> str:
+        return f"{img_hash}_{self.model_tag}"
+
+    def _paths(self, key: str):
+        base = os.path.join(self.store_dir, key)
+        return base + ".bin", base + ".json"
+
+    def contains(self, img_hash: str) -> bool:
+        return self._key(img_hash) in self.index
+
+    def get(self, img_hash: str, device) -> Optional[Dict[str, Any]]:
+        """Load features for an image hash, or None if not stored."""
+        key = self._key(img_hash)
+        with self.lock:
+            if key not in self.index:
+                return None
+            bin_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path, "r") as f:
+                    meta = json.load(f)
+                flat = np.memmap(bin_path, dtype=np.float16, mode="r")
+            except (OSError, ValueError) as e:
+                print(f"Dropping unreadable embedding {key}: {e}")
+                self._remove(key)
+                return None
+            os.utime(meta_path)
+            self.index[key]["atime"] = os.path.getmtime(meta_path)
+
+        try:
+            tensors = []
+            offset = 0
+            for shape in meta["shapes"]:
+                count = int(np.prod(shape))
+                chunk = np.asarray(flat[offset:offset + count], dtype=np.float32).reshape(shape)
+                tensors.append(torch.from_numpy(chunk).to(device))
+                offset += count
+            orig_hw = [tuple(hw) for hw in meta["orig_hw"]]
+            orig_size = tuple(meta["orig_size"])
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Dropping corrupt embedding {key}: {e}")
+            del flat  # Release the mapping before deleting the file
+            with self.lock:
+                self._remove(key)
+            return None
+        del flat
+
+        features = {"image_embed": tensors[0], "high_res_feats": tensors[1:]}
+        return {"features": features, "orig_hw": orig_hw, "orig_size": orig_size}
+
+    def put(self, img_hash: str, features, orig_hw, orig_size):
+        """Persist features as fp16, evicting least recently used entries past the size cap."""
+        key = self._key(img_hash)
+        if key in self.index:
+            return
+        bin_path, meta_path = self._paths(key)
+
+        tensors = [features["image_embed"], *features["high_res_feats"]]
+        arrays = [t.detach().to("cpu", torch.float16).numpy() for t in tensors]
+        meta = {
+            "shapes": [list(a.shape) for a in arrays],
+            "orig_hw": [list(hw) for hw in orig_hw],
+            "orig_size": list(orig_size),
+        }
+
+        # Unique temp names, so concurrent writers of the same key never share a file
+        tmp_paths = []
+        try:
+            fd, tmp_bin = tempfile.mkstemp(dir=self.store_dir, prefix=key, suffix=".bin.tmp")
+            tmp_paths.append(tmp_bin)
+            with os.fdopen(fd, "wb") as f:
+                for a in arrays:
+                    f.write(np.ascontiguousarray(a).tobytes())
+            fd, tmp_meta = tempfile.mkstemp(dir=self.store_dir, prefix=key, suffix=".json.tmp")
+            tmp_paths.append(tmp_meta)
+            with os.fdopen(fd, "w") as f:
+                json.dump(meta, f)
+            nbytes = os.path.getsize(tmp_bin) + os.path.getsize(tmp_meta)
+
+            with self.lock:
+                if key not in self.index:
+                    os.replace(tmp_bin, bin_path)
+                    os.replace(tmp_meta, meta_path)
+                    self.index[key] = {"nbytes": nbytes, "atime": os.path.getmtime(meta_path)}
+                    self.total_bytes += nbytes
+                    self._evict()
+        except OSError as e:
+            print(f"Failed to persist embedding {key}: {e}")
+            with self.lock:
+                if key not in self.index:
+                    self._remove(key)
+        finally:
+            for p in tmp_paths:
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.index) > 1:
+            oldest = min(self.index, key=lambda k: self.index[k]["atime"])
+            self._remove(oldest)
+
+    def _remove(self, key: str):
+        entry = self.index.pop(key, None)
+        if entry:
+            self.total_bytes -= entry["nbytes"]
+        for p in self._paths(key):
+            if os.path.exists(p):
+                os.remove(p)
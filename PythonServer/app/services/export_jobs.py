@@ -0,0 +1,159 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app.core.config import get_settings
+from app.core.database import get_db_connection
+from app.services.autosave_service import autosave_service
+from app.services.export_service import export_service
+
+# Seconds between progress writes to the export_jobs row
+_PROGRESS_INTERVAL = 0.5
+
+class ExportJobService:
+    """
+    Runs exports in the background. Job state lives in the export_jobs table:
+    queued -> running -> completed | failed | cancelled. A job still queued or running when
+    the server stops is restarted from scratch on the next startup (or marked "interrupted"
+    when EXPORT_RESUME_JOBS is off); any partial output it left behind is removed first.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.executor = ThreadPoolExecutor(max_workers=self.settings.EXPORT_JOB_WORKERS, thread_name_prefix="export-job")
+        self.cancel_events: Dict[int, threading.Event] = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def submit(self, project_id: int, format: str, incremental: bool = False) -> Dict[str, Any]:
+        if not export_service.supports(format):
+            return {"error": f"Unsupported format: {format}"}
+        with get_db_connection() as conn:
+            cursor = conn.execute(
+                "INSERT INTO export_jobs (project_id, format, incremental, status) VALUES (?, ?, ?, 'queued')",
+                (project_id, format, int(incremental)))
+            job_id = cursor.lastrowid
+            conn.commit()
+        self._start(job_id)
+        return self.get(job_id)
+
+    def _start(self, job_id: int):
+        event = threading.Event()
+        with self.lock:
+            self.cancel_events[job_id] = event
+        self.executor.submit(self._run, job_id, event)
+
+    def _update(self, job_id: int, **fields):
+        columns = ", ".join(f"{k} = ?" for k in fields)
+        with get_db_connection() as conn:
+            conn.execute(
+                f"UPDATE export_jobs SET {columns}, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (*fields.values(), job_id))
+            conn.commit()
+
+    def _run(self, job_id: int, cancelled: threading.Event):
+        try:
+            job = self.get(job_id)
+            if job is None or cancelled.is_set() or job["status"] != "queued":
+                return
+
+            if job["incremental"]:
+                path = export_service.incremental_dir(job["project_id"], job["format"])
+            else:
+                path = export_service.new_export_dir(job["project_id"], job["format"], job_id)
+            self._update(job_id, status="running", path=path, done=0, total=0, error=None)
+            autosave_service.flush(job["project_id"])
+
+            last_write = 0.0
+            def progress(done, total):
+                nonlocal last_write
+                now = time.monotonic()
+                if done == total or now - last_write >= _PROGRESS_INTERVAL:
+                    last_write = now
+                    self._update(job_id, done=done, total=total)
+
+            result = export_service.export_project(
+                job["project_id"], job["format"], progress=progress, is_cancelled=cancelled.is_set,
+                export_dir=path, incremental=job["incremental"])
+
+            if result.get("status") == "success":
+                self._update(job_id, status="completed", path=result["path"])
+            elif result.get("status") == "cancelled":
+                if not self.stopping:  # Stopped by shutdown: leave "running" so recover() picks it up
+                    self._update(job_id, status="cancelled", path=None)
+            else:
+                self._update(job_id, status="failed", error=result.get("error"))
+        except Exception as e:
+            print(f"Export job {job_id} failed: {e}")
+            self._update(job_id, status="failed", error=str(e))
+        finally:
+            with self.lock:
+                self.cancel_events.pop(job_id, None)
+
+    def cancel(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            event = self.cancel_events.get(job_id)
+        if event:
+            event.set()
+        with get_db_connection() as conn:
+            # A queued job never reaches export_project, so mark it here; running jobs mark themselves
+            conn.execute(
+                "UPDATE export_jobs SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'queued'",
+                (job_id,))
+            conn.commit()
+        return self.get(job_id)
+
+    def _to_dict(self, row) -> Dict[str, Any]:
+        total = row["total"]
+        return {
+            "job_id": row["id"],
+            "project_id": row["project_id"],
+            "format": row["format"],
+            "incremental": bool(row["incremental"]),
+            "status": row["status"],
+            "done": row["done"],
+            "total": total,
+            "percent": round(100.0 * row["done"] / total, 1) if total else (100.0 if row["status"] == "completed" else 0.0),
+            "path": row["path"],
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with get_db_connection() as conn:
+            row = conn.execute("SELECT * FROM export_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list_jobs(self, project_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+        with get_db_connection() as conn:
+            cursor = conn.execute(
+                "SELECT * FROM export_jobs WHERE project_id = ? ORDER BY id DESC LIMIT ?", (project_id, limit))
+            return [self._to_dict(r) for r in cursor.fetchall()]
+
+    def recover(self):
+        """Called at startup: resume (or report) jobs the previous process did not finish."""
+        with get_db_connection() as conn:
+            rows = conn.execute(
+                "SELECT id, status, path, incremental FROM export_jobs WHERE status IN ('queued', 'running') ORDER BY id").fetchall()
+        for job_id, status, path, incremental in rows:
+            # An incremental target is kept: its manifest still describes what was fully written
+            if status == "running" and not incremental and path and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            if self.settings.EXPORT_RESUME_JOBS:
+                print(f"Resuming export job {job_id}")
+                self._update(job_id, status="queued", path=None, done=0, total=0)
+                self._start(job_id)
+            else:
+                self._update(job_id, status="interrupted", path=None)
+
+    def shutdown(self):
+        self.stopping = True
+        with self.lock:
+            for event in self.cancel_events.values():
+                event.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+export_job_service = ExportJobService()
@@ -1,29 +1,75 @@
 import os
+import multiprocessing
 import time
 import json
-import sqlite3
+import shutil
+import hashlib
 import cv2
 import numpy as np
-from typing import Dict, Any, List
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from itertools import islice
+from typing import Dict, Any, List, Callable, Iterator, Optional, Tuple
 
 from app.core.config import get_settings
 from app.core.database import get_db_connection
+from app.services.annotation_service import annotation_service
+from app.services.image_service import image_service
+from app.services.export_writers import WRITERS, output_name, write_batch
+
+class ExportCancelled(Exception):
+    pass
 
 class ExportService:
     def __init__(self):
         self.settings = get_settings()
 
-    def export_project(self, project_id: int, format: str) -> Dict[str, Any]:
-        """Export project data to the specified format."""
-        
+    def new_export_dir(self, project_id: int, format: str, job_id: Optional[int] = None) -> str:
         timestamp = int(time.time())
         base_dir = self.settings.EXPORT_DIR
         if not os.path.exists(base_dir):
             os.makedirs(base_dir)
-            
-        export_dir = os.path.join(base_dir, f"project_{project_id}_{format}_{timestamp}")
-        os.makedirs(export_dir)
-        
+        name = f"project_{project_id}_{format}_{timestamp}"
+        if job_id is not None:
+            name += f"_job{job_id}"
+        return os.path.join(base_dir, name)
+
+    def incremental_dir(self, project_id: int, format: str) -> str:
+        return os.path.join(self.settings.EXPORT_DIR, f"project_{project_id}_{format}")
+
+    def supports(self, format: str) -> bool:
+        return format == "coco" or format in WRITERS
+
+    def export_project(
+        self,
+        project_id: int,
+        format: str,
+        progress: Optional[Callable[[int, int], None]] = None,
+        is_cancelled: Optional[Callable[[], bool]] = None,
+        export_dir: Optional[str] = None,
+        incremental: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Export project data to the specified format. Annotations are streamed from the database in
+        chunks, so memory use does not grow with project size. progress(done, total) is called as
+        images are written; once is_cancelled() returns True the export stops and its output is removed.
+
+        With incremental, output goes to a fixed per-format directory and only images whose
+        annotations or dims changed since the last incremental export are rewritten (see
+        _export_incremental); export_dir is ignored.
+        """
+        if not self.supports(format):
+            return {"error": f"Unsupported format: {format}"}
+
+        if not incremental:
+            export_dir = export_dir or self.new_export_dir(project_id, format)
+            os.makedirs(export_dir)
+
+        def report(done, total):
+            if is_cancelled and is_cancelled():
+                raise ExportCancelled()
+            if progress:
+                progress(done, total)
+
         try:
             with get_db_connection() as conn:
                 # Fetch project data
@@ -32,206 +78,268 @@ class ExportService:
                 categories = json.loads(cat_row[0]) if cat_row and cat_row[0] else []
                 cat_map = {c["name"]: i+1 for i, c in enumerate(categories)}
 
-                cursor = conn.execute("SELECT image_name, data FROM annotations_v2 WHERE project_id = ?", (project_id,))
-                records = cursor.fetchall()
-                
-                cursor = conn.execute("SELECT image_paths FROM project_state WHERE project_id = ?", (project_id,))
-                path_row = cursor.fetchone()
-                image_paths = json.loads(path_row[0]) if path_row and path_row[0] else {}
-
-            if format == 'coco':
-                return self._export_coco(export_dir, records, categories, cat_map, image_paths)
-            elif format == 'voc':
-                return self._export_voc(export_dir, records, image_paths)
-            elif format == 'yolo':
-                return self._export_yolo(export_dir, records, cat_map, image_paths)
-            elif format == 'masks':
-                return self._export_masks(export_dir, records, cat_map, image_paths)
-            else:
-                return {"error": f"Unsupported format: {format}"}
+                total = annotation_service.count_saved_images(conn, project_id)
+                if incremental:
+                    return self._export_incremental(conn, project_id, format, categories, cat_map, total, report)
+                report(0, total)
+
+                records = self._iter_records(conn, project_id)
 
+                if format == 'coco':
+                    self._export_coco(export_dir, records, categories, cat_map, total, report)
+                else:
+                    self._export_per_image(format, export_dir, records, cat_map, total, report)
+            return {"status": "success", "path": export_dir}
+
+        except ExportCancelled:
+            # Incremental output stays: its manifest was not updated, so the next run redoes this work
+            if not incremental:
+                shutil.rmtree(export_dir, ignore_errors=True)
+            return {"status": "cancelled"}
         except Exception as e:
             return {"error": str(e)}
 
-    def _export_coco(self, export_dir, records, categories, cat_map, image_paths):
-        coco_data = {
-            "info": {"description": "Exported from ProAnnotator", "date_created": time.ctime()},
-            "images": [],
-            "annotations": [],
-            "categories": [{"id": i+1, "name": c["name"]} for i, c in enumerate(categories)]
+    def _iter_records(self, conn, project_id) -> Iterator[Tuple[str, List[Dict[str, Any]], int, int]]:
+        """Yield (image_name, annotations, width, height), resolving dims one chunk of images at a time."""
+        records = annotation_service.iter_project_annotations(conn, project_id)
+        while True:
+            chunk = list(islice(records, self.settings.EXPORT_CHUNK_SIZE))
+            if not chunk:
+                return
+            dims = self._resolve_dims(conn, project_id, [name for name, _ in chunk])
+            for name, anns in chunk:
+                yield (name, anns, *dims[name])
+
+    def _export_incremental(self, conn, project_id, format, categories, cat_map, total, report) -> Dict[str, Any]:
+        """
+        Bring the project's stable export directory up to date. An image is rewritten when its
+        annotation version or dims differ from the manifest; outputs of images that are no longer
+        saved in the project are deleted. COCO is a single file, so it is rewritten whole, but only
+        if anything changed. A change to the category list invalidates everything.
+        """
+        export_dir = self.incremental_dir(project_id, format)
+        categories_hash = hashlib.sha1(json.dumps(categories, sort_keys=True).encode()).hexdigest()
+        target = conn.execute(
+            "SELECT categories_hash FROM export_targets WHERE project_id = ? AND format = ?", (project_id, format)).fetchone()
+
+        rebuild = target is None or target[0] != categories_hash or not os.path.isdir(export_dir)
+        if rebuild:
+            # Committed up front, so an interrupted rebuild is redone from scratch next time
+            shutil.rmtree(export_dir, ignore_errors=True)
+            os.makedirs(export_dir)
+            conn.execute("DELETE FROM export_targets WHERE project_id = ? AND format = ?", (project_id, format))
+            conn.execute("DELETE FROM export_manifest WHERE project_id = ? AND format = ?", (project_id, format))
+            conn.commit()
+
+        # Versions are read before the annotations: a save landing mid-export gets a newer
+        # version than the one recorded here, so the next export picks it up
+        versions = annotation_service.versions(conn, project_id)
+        removed = [r[0] for r in conn.execute(
+            '''SELECT image_name FROM export_manifest m WHERE project_id = ? AND format = ? AND NOT EXISTS (
+                   SELECT 1 FROM image_versions v WHERE v.project_id = m.project_id AND v.image_name = m.image_name)''',
+            (project_id, format))]
+        # Diff against the manifest first, so the per-image writers know how much work there is
+        changed = self._changed_entries(conn, project_id, format, versions)
+
+        if format == "coco":
+            report(0, total)
+            if changed or removed or rebuild:
+                tmp_dir = export_dir + ".tmp"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                self._export_coco(tmp_dir, self._iter_records(conn, project_id), categories, cat_map, total, report)
+                os.replace(os.path.join(tmp_dir, "annotations.json"), os.path.join(export_dir, "annotations.json"))
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            report(total, total)
+        else:
+            def changed_records():
+                for name, anns in annotation_service.iter_project_annotations(conn, project_id):
+                    entry = changed.get(name)
+                    if entry is None:
+                        continue
+                    # The writer may legitimately produce no file now (e.g. YOLO with no known class)
+                    old = os.path.join(export_dir, output_name(format, name))
+                    if os.path.exists(old):
+                        os.remove(old)
+                    yield name, anns, entry[1], entry[2]
+
+            report(0, len(changed))
+            self._export_per_image(format, export_dir, changed_records(), cat_map, len(changed), report)
+            for name in removed:
+                old = os.path.join(export_dir, output_name(format, name))
+                if os.path.exists(old):
+                    os.remove(old)
+            report(len(changed), len(changed))
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO export_manifest (project_id, format, image_name, version, width, height) VALUES (?, ?, ?, ?, ?, ?)",
+            [(project_id, format, name, *entry) for name, entry in changed.items()])
+        conn.executemany(
+            "DELETE FROM export_manifest WHERE project_id = ? AND format = ? AND image_name = ?",
+            [(project_id, format, name) for name in removed])
+        conn.execute(
+            '''INSERT OR REPLACE INTO export_targets (project_id, format, path, categories_hash, updated_at)
+               VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)''', (project_id, format, export_dir, categories_hash))
+        conn.commit()
+        return {
+            "status": "success",
+            "path": export_dir,
+            "incremental": True,
+            "rebuilt": rebuild,
+            "written": len(changed),
+            "removed": len(removed),
         }
-        
+
+    def _changed_entries(self, conn, project_id, format, versions) -> Dict[str, Tuple[int, int, int]]:
+        """{image_name: (version, width, height)} for saved images whose manifest entry is stale or missing."""
+        names = sorted(versions)
+        changed = {}
+        for start in range(0, len(names), self.settings.EXPORT_CHUNK_SIZE):
+            chunk = names[start:start + self.settings.EXPORT_CHUNK_SIZE]
+            dims = self._resolve_dims(conn, project_id, chunk)
+            manifest = self._manifest_entries(conn, project_id, format, chunk)
+            for name in chunk:
+                entry = (versions.get(name, 0), *dims[name])
+                if manifest.get(name) != entry:
+                    changed[name] = entry
+        return changed
+
+    def _manifest_entries(self, conn, project_id, format, names) -> Dict[str, Tuple[int, int, int]]:
+        cursor = conn.execute(
+            f'''SELECT image_name, version, width, height FROM export_manifest
+                WHERE project_id = ? AND format = ? AND image_name IN ({",".join("?" * len(names))})''',
+            [project_id, format, *names])
+        return {name: (version, width, height) for name, version, width, height in cursor}
+
+    def _export_coco(self, export_dir, records, categories, cat_map, total, progress):
+        """
+        Write annotations.json incrementally: images go straight to the output file while the
+        annotations are spooled to a side file and appended once all images are written.
+        """
+        out_path = os.path.join(export_dir, "annotations.json")
+        spool_path = os.path.join(export_dir, ".annotations.part")
+        info = {"description": "Exported from ProAnnotator", "date_created": time.ctime()}
+
         ann_id = 1
-        for img_id, (img_name, ann_json) in enumerate(records, 1):
-            width, height = self._get_image_dims(image_paths.get(img_name))
-            
-            coco_data["images"].append({
-                "id": img_id,
-                "file_name": img_name,
-                "width": width,
-                "height": height
-            })
-            
-            anns = json.loads(ann_json)
-            for ann in anns:
-                cls_name = ann.get("className")
-                cat_id = cat_map.get(cls_name, 0)
-                points = ann.get("points", [])
-                
-                if not points: continue
-                
-                # Validate category
-                if cat_id == 0:
-                    print(f"Warning: Skipping annotation with unknown class '{cls_name}'")
-                    continue
-
-                coco_seg = []
-                pts_list = [] # For opencv area
-                for p in points:
-                    coco_seg.extend([p["x"], p["y"]])
-                    pts_list.append([p["x"], p["y"]])
-                
-                if len(pts_list) < 3: continue # Not a valid polygon
-
-                xs = [p["x"] for p in points]
-                ys = [p["y"] for p in points]
-                
-                x_min, x_max = min(xs), max(xs)
-                y_min, y_max = min(ys), max(ys)
-                
-                # Calculate Polygon Area
-                try:
-                    poly_np = np.array(pts_list, dtype=np.float32)
-                    area = float(cv2.contourArea(poly_np))
-                except:
-                    area = float((x_max - x_min) * (y_max - y_min)) # Fallback
-
-                coco_data["annotations"].append({
-                    "id": ann_id,
-                    "image_id": img_id,
-                    "category_id": cat_id,
-                    "segmentation": [coco_seg],
-                    "bbox": [x_min, y_min, x_max - x_min, y_max - y_min],
-                    "area": area,
-                    "iscrowd": 0
-                })
-                ann_id += 1
-                
-        with open(os.path.join(export_dir, "annotations.json"), "w") as f:
-            json.dump(coco_data, f, indent=2)
-            
-        return {"status": "success", "path": export_dir}
-
-    def _export_voc(self, export_dir, records, image_paths):
-        import xml.etree.ElementTree as ET
-        from xml.dom import minidom
-        
-        for img_name, ann_json in records:
-            anns = json.loads(ann_json)
-            if not anns: continue
-            
-            width, height = self._get_image_dims(image_paths.get(img_name))
-            
-            root = ET.Element("annotation")
-            ET.SubElement(root, "folder").text = "images"
-            ET.SubElement(root, "filename").text = img_name
-            
-            size = ET.SubElement(root, "size")
-            ET.SubElement(size, "width").text = str(width)
-            ET.SubElement(size, "height").text = str(height)
-            ET.SubElement(size, "depth").text = "3"
-
-            for ann in anns:
-                obj = ET.SubElement(root, "object")
-                ET.SubElement(obj, "name").text = ann.get("className", "unknown")
-                ET.SubElement(obj, "pose").text = "Unspecified"
-                ET.SubElement(obj, "truncated").text = "0"
-                ET.SubElement(obj, "difficult").text = "0"
-                
-                points = ann.get("points", [])
-                if points:
-                    xs = [p["x"] for p in points]
-                    ys = [p["y"] for p in points]
-                    bndbox = ET.SubElement(obj, "bndbox")
-                    ET.SubElement(bndbox, "xmin").text = str(min(xs))
-                    ET.SubElement(bndbox, "ymin").text = str(min(ys))
-                    ET.SubElement(bndbox, "xmax").text = str(max(xs))
-                    ET.SubElement(bndbox, "ymax").text = str(max(ys))
-            
-            xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
-            out_name = os.path.splitext(img_name)[0] + ".xml"
-            with open(os.path.join(export_dir, out_name), "w") as f:
-                f.write(xml_str)
-                
-        return {"status": "success", "path": export_dir}
-
-    def _export_yolo(self, export_dir, records, cat_map, image_paths):
-        for img_name, ann_json in records:
-            anns = json.loads(ann_json)
-            if not anns: continue
-            
-            width, height = self._get_image_dims(image_paths.get(img_name))
-            
-            lines = []
-            for ann in anns:
-                cls_name = ann.get("className")
-                cat_id = cat_map.get(cls_name)
-                if cat_id is None: continue
-                class_idx = cat_id - 1
-                
-                points = ann.get("points", [])
-                if points:
-                    xs = [p["x"] for p in points]
-                    ys = [p["y"] for p in points]
-                    x_min, x_max = min(xs), max(xs)
-                    y_min, y_max = min(ys), max(ys)
-                    
-                    if width == 0 or height == 0: continue
-
-                    dw = 1.0 / width
-                    dh = 1.0 / height
-                    x_center = (x_min + x_max) / 2.0 * dw
-                    y_center = (y_min + y_max) / 2.0 * dh
-                    w = (x_max - x_min) * dw
-                    h = (y_max - y_min) * dh
-                    
-                    lines.append(f"{class_idx} {x_center:.6f} {y_center:.6f} {w:.6f} {h:.6f}")
-            
-            if lines:
-                out_name = os.path.splitext(img_name)[0] + ".txt"
-                with open(os.path.join(export_dir, out_name), "w") as f:
-                    f.write("\n".join(lines))
-                    
-        return {"status": "success", "path": export_dir}
-
-    def _export_masks(self, export_dir, records, cat_map, image_paths):
-        for img_name, ann_json in records:
-            anns = json.loads(ann_json)
-            width, height = self._get_image_dims(image_paths.get(img_name))
-            
-            mask = np.zeros((height, width), dtype=np.uint8)
-            
-            for ann in anns:
-                cls_name = ann.get("className")
-                cat_id = cat_map.get(cls_name, 0)
-                points = ann.get("points", [])
-                if points:
-                    pts = np.array([[p["x"], p["y"]] for p in points], np.int32)
-                    pts = pts.reshape((-1, 1, 2))
-                    cv2.fillPoly(mask, [pts], int(cat_id))
-
-            out_name = os.path.splitext(img_name)[0] + ".png"
-            cv2.imwrite(os.path.join(export_dir, out_name), mask)
-            
-        return {"status": "success", "path": export_dir}
-
-    def _get_image_dims(self, path):
-        if path and os.path.exists(path):
+        with open(out_path, "w") as out, open(spool_path, "w+") as spool:
+            out.write('{\n"info": ' + json.dumps(info) + ',\n"images": [\n')
+            for img_id, (img_name, anns, width, height) in enumerate(records, 1):
+                if img_id > 1:
+                    out.write(",\n")
+                out.write(json.dumps({"id": img_id, "file_name": img_name, "width": width, "height": height}))
+
+                for ann in anns:
+                    coco_ann = self._coco_annotation(ann, cat_map)
+                    if coco_ann is None:
+                        continue
+                    if ann_id > 1:
+                        spool.write(",\n")
+                    spool.write(json.dumps({"id": ann_id, "image_id": img_id, **coco_ann}))
+                    ann_id += 1
+                progress(img_id, total)
+
+            out.write('\n],\n"annotations": [\n')
+            spool.seek(0)
+            shutil.copyfileobj(spool, out)
+            out.write('\n],\n"categories": ')
+            out.write(json.dumps([{"id": i+1, "name": c["name"]} for i, c in enumerate(categories)]))
+            out.write('\n}\n')
+        os.remove(spool_path)
+
+    def _coco_annotation(self, ann, cat_map) -> Optional[Dict[str, Any]]:
+        """COCO fields for one shape (without ids), or None if the shape is skipped."""
+        cls_name = ann.get("className")
+        cat_id = cat_map.get(cls_name, 0)
+        points = ann.get("points", [])
+
+        if not points:
+            return None
+
+        # Validate category
+        if cat_id == 0:
+            print(f"Warning: Skipping annotation with unknown class '{cls_name}'")
+            return None
+
+        coco_seg = []
+        pts_list = [] # For opencv area
+        for p in points:
+            coco_seg.extend([p["x"], p["y"]])
+            pts_list.append([p["x"], p["y"]])
+
+        if len(pts_list) < 3: return None # Not a valid polygon
+
+        xs = [p["x"] for p in points]
+        ys = [p["y"] for p in points]
+
+        x_min, x_max = min(xs), max(xs)
+        y_min, y_max = min(ys), max(ys)
+
+        # Calculate Polygon Area
+        try:
+            poly_np = np.array(pts_list, dtype=np.float32)
+            area = float(cv2.contourArea(poly_np))
+        except:
+            area = float((x_max - x_min) * (y_max - y_min)) # Fallback
+
+        return {
+            "category_id": cat_id,
+            "segmentation": [coco_seg],
+            "bbox": [x_min, y_min, x_max - x_min, y_max - y_min],
+            "area": area,
+            "iscrowd": 0
+        }
+
+    def _export_per_image(self, format, export_dir, records, cat_map, total, progress):
+        """
+        VOC XML, YOLO txt and mask PNGs are independent per image, so batches of images are
+        written by a process pool. The number of batches in flight is capped to keep memory bounded.
+        Small exports run inline, where pool start-up would cost more than it saves.
+        """
+        batch_size = self.settings.EXPORT_BATCH_SIZE
+        workers = self.settings.EXPORT_WORKERS or os.cpu_count() or 1
+        if workers <= 1 or total < self.settings.EXPORT_PARALLEL_MIN_IMAGES:
+            writer = WRITERS[format]
+            for done, (img_name, anns, width, height) in enumerate(records, 1):
+                writer(export_dir, img_name, anns, width, height, cat_map)
+                progress(done, total)
+            return
+
+        done = 0
+        # spawn: forking a process that holds the model, CUDA state and live threads is unsafe
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
             try:
-                img = cv2.imread(path)
-                if img is not None:
-                    return img.shape[1], img.shape[0] # w, h
-            except: pass
-        return 800, 600
+                pending = {}
+                batches = iter(lambda: list(islice(records, batch_size)), [])
+                for batch in batches:
+                    pending[pool.submit(write_batch, format, export_dir, batch, cat_map)] = len(batch)
+                    if len(pending) >= workers * 2:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            future.result()
+                            done += pending.pop(future)
+                        progress(done, total)
+                for future in as_completed(pending):
+                    future.result()
+                    done += pending[future]
+                    progress(done, total)
+            except BaseException:
+                # Cancelled or failed: drop the batches that have not started yet
+                pool.shutdown(wait=True, cancel_futures=True)
+                raise
+
+    def _resolve_dims(self, conn, project_id, names):
+        """(width, height) per image name, read from the image dimension index (header probe on a miss)."""
+        paths = image_service.paths_for(conn, project_id, names)
+        probed = image_service.get_dims(conn, paths.values())
+        conn.commit()  # Keep the probe results, and don't hold the write lock for the rest of the export
+        dims = {}
+        for name in names:
+            path = paths.get(name)
+            size = probed.get(path) if path else None
+            if size is None:
+                print(f"Warning: Could not read dimensions of '{name}', using 800x600")
+                size = (800, 600)
+            dims[name] = size
+        return dims
 
 export_service = ExportService()
@@ -0,0 +1,115 @@
+"""
+Per-image export writers. Kept free of app imports so process-pool workers start quickly
+(each worker imports only this module).
+"""
+import os
+import cv2
+import numpy as np
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+from typing import Any, Dict, List, Optional
+
+OUTPUT_EXTENSIONS = {
+    "voc": ".xml",
+    "yolo": ".txt",
+    "masks": ".png",
+}
+
+def output_name(writer_name: str, img_name: str) -> str:
+    return os.path.splitext(img_name)[0] + OUTPUT_EXTENSIONS[writer_name]
+
+def write_voc(export_dir: str, img_name: str, anns: List[Dict[str, Any]], width: int, height: int,
+              cat_map: Dict[str, int]) -> Optional[str]:
+    if not anns:
+        return None
+
+    root = ET.Element("annotation")
+    ET.SubElement(root, "folder").text = "images"
+    ET.SubElement(root, "filename").text = img_name
+
+    size = ET.SubElement(root, "size")
+    ET.SubElement(size, "width").text = str(width)
+    ET.SubElement(size, "height").text = str(height)
+    ET.SubElement(size, "depth").text = "3"
+
+    for ann in anns:
+        obj = ET.SubElement(root, "object")
+        ET.SubElement(obj, "name").text = ann.get("className", "unknown")
+        ET.SubElement(obj, "pose").text = "Unspecified"
+        ET.SubElement(obj, "truncated").text = "0"
+        ET.SubElement(obj, "difficult").text = "0"
+
+        points = ann.get("points", [])
+        if points:
+            xs = [p["x"] for p in points]
+            ys = [p["y"] for p in points]
+            bndbox = ET.SubElement(obj, "bndbox")
+            ET.SubElement(bndbox, "xmin").text = str(min(xs))
+            ET.SubElement(bndbox, "ymin").text = str(min(ys))
+            ET.SubElement(bndbox, "xmax").text = str(max(xs))
+            ET.SubElement(bndbox, "ymax").text = str(max(ys))
+
+    xml_str = minidom.parseString(ET.tostring(root)).toprettyxml(indent="  ")
+    out_name = output_name("voc", img_name)
+    with open(os.path.join(export_dir, out_name), "w") as f:
+        f.write(xml_str)
+    return out_name
+
+def write_yolo(export_dir: str, img_name: str, anns: List[Dict[str, Any]], width: int, height: int,
+               cat_map: Dict[str, int]) -> Optional[str]:
+    if not anns or width == 0 or height == 0:
+        return None
+
+    lines = []
+    dw = 1.0 / width
+    dh = 1.0 / height
+    for ann in anns:
+        cat_id = cat_map.get(ann.get("className"))
+        if cat_id is None:
+            continue
+        class_idx = cat_id - 1
+
+        points = ann.get("points", [])
+        if points:
+            xs = [p["x"] for p in points]
+            ys = [p["y"] for p in points]
+            x_min, x_max = min(xs), max(xs)
+            y_min, y_max = min(ys), max(ys)
+
+            x_center = (x_min + x_max) / 2.0 * dw
+            y_center = (y_min + y_max) / 2.0 * dh
+            w = (x_max - x_min) * dw
+            h = (y_max - y_min) * dh
+            lines.append(f"{class_idx} {x_center:.6f} {y_center:.6f} {w:.6f} {h:.6f}")
+
+    if not lines:
+        return None
+    out_name = output_name("yolo", img_name)
+    with open(os.path.join(export_dir, out_name), "w") as f:
+        f.write("\n".join(lines))
+    return out_name
+
+def write_mask(export_dir: str, img_name: str, anns: List[Dict[str, Any]], width: int, height: int,
+               cat_map: Dict[str, int]) -> Optional[str]:
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for ann in anns:
+        cat_id = cat_map.get(ann.get("className"), 0)
+        points = ann.get("points", [])
+        if points:
+            pts = np.array([[p["x"], p["y"]] for p in points], np.int32).reshape((-1, 1, 2))
+            cv2.fillPoly(mask, [pts], int(cat_id))
+
+    out_name = output_name("masks", img_name)
+    cv2.imwrite(os.path.join(export_dir, out_name), mask)
+    return out_name
+
+def write_batch(writer_name: str, export_dir: str, items: list, cat_map: Dict[str, int]) -> List[Optional[str]]:
+    """Run one writer over a list of (img_name, anns, width, height); one pool task per batch."""
+    writer = WRITERS[writer_name]
+    return [writer(export_dir, name, anns, w, h, cat_map) for name, anns, w, h in items]
+
+WRITERS = {
+    "voc": write_voc,
+    "yolo": write_yolo,
+    "masks": write_mask,
+}
@@ -0,0 +1,164 @@
+import struct
+import cv2
+import numpy as np
+from typing import Optional, Tuple
+
+# libjpeg can decode directly at 1/2, 1/4 and 1/8 scale via scaled IDCT
+_REDUCED_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...), excluding DHT/JPG/DAC
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _exif_orientation(segment: bytes) -> int:
+    """Orientation tag (1-8) from an APP1 Exif payload, 1 if absent."""
+    if segment[:6] != b"Exif\x00\x00":
+        return 1
+    tiff = segment[6:]
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return 1
+    try:
+        ifd = struct.unpack(endian + "I", tiff[4:8])[0]
+        count = struct.unpack(endian + "H", tiff[ifd:ifd + 2])[0]
+        for i in range(count):
+            entry = ifd + 2 + i * 12
+            if struct.unpack(endian + "H", tiff[entry:entry + 2])[0] == 0x0112:
+                return struct.unpack(endian + "H", tiff[entry + 8:entry + 10])[0]
+    except struct.error:
+        pass
+    return 1
+
+def _jpeg_info(data: bytes) -> Tuple[Optional[Tuple[int, int]], int]:
+    """Stored (width, height) and EXIF orientation of a JPEG, scanning markers up to the first SOF."""
+    idx = 2
+    n = len(data)
+    orientation = 1
+    while idx + 9 < n:
+        if data[idx] != 0xFF:
+            idx += 1
+            continue
+        marker = data[idx + 1]
+        if marker == 0xFF:  # Fill byte
+            idx += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # Standalone markers
+            idx += 2
+            continue
+        seg_len = struct.unpack(">H", data[idx + 2:idx + 4])[0]
+        if marker == 0xE1 and orientation == 1:
+            orientation = _exif_orientation(data[idx + 4:idx + 2 + seg_len])
+        if marker in _JPEG_SOF_MARKERS:
+            h, w = struct.unpack(">HH", data[idx + 5:idx + 9])
+            return (w, h), orientation
+        idx += 2 + seg_len
+    return None, orientation
+
+def _jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    return _jpeg_info(data)[0]
+
+def _png_size(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+def _webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b"VP8 ":  # Lossy: 14-bit dims after the 3-byte frame tag and start code
+        w, h = struct.unpack("<HH", data[26:30])
+        return w & 0x3FFF, h & 0x3FFF
+    if chunk == b"VP8L":  # Lossless: 14-bit dims packed after the 0x2F signature
+        bits = struct.unpack("<I", data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":  # Extended: 24-bit canvas size minus one
+        w = int.from_bytes(data[24:27], "little") + 1
+        h = int.from_bytes(data[27:30], "little") + 1
+        return w, h
+    return None
+
+def _bmp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    if len(data) < 26:
+        return None
+    w, h = struct.unpack("<ii", data[18:26])  # Negative height marks a top-down bitmap
+    return abs(w), abs(h)
+
+def probe_image_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """Read (width, height) from a JPEG, PNG, WebP or BMP header without decoding pixels."""
+    if data[:2] == b"\xff\xd8":
+        return _jpeg_size(data)
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return _png_size(data)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _webp_size(data)
+    if data[:2] == b"BM":
+        return _bmp_size(data)
+    return None
+
+# Header reads grow through these sizes until the dims are found (large EXIF thumbnails push SOF back)
+_PROBE_READ_SIZES = (64 * 1024, 1024 * 1024)
+
+def read_image_size(path: str) -> Optional[Tuple[int, int]]:
+    """
+    Display (width, height) of an image file from its header alone, with JPEG EXIF rotation
+    applied the way cv2.imread does. None if the format is unknown or the header is unreadable.
+    """
+    with open(path, "rb") as f:
+        data = b""
+        for size in _PROBE_READ_SIZES:
+            data += f.read(size - len(data))
+            if data[:2] == b"\xff\xd8":
+                dims, orientation = _jpeg_info(data)
+                if dims:
+                    # Orientations 5-8 are transposed
+                    return (dims[1], dims[0]) if 5 <= orientation <= 8 else dims
+            else:
+                dims = probe_image_size(data)
+                if dims:
+                    return dims
+            if len(data) < size:  # Hit EOF
+                break
+    return None
+
+def decode_for_model(image_bytes: bytes, max_size: int) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Decode to RGB with its longest side at most max_size, using the smallest JPEG
+    reduced-scale decode that still covers max_size. Returns the image and the
+    original (w, h).
+    """
+    np_img = np.frombuffer(image_bytes, np.uint8)
+    header_size = probe_image_size(image_bytes) if image_bytes[:2] == b"\xff\xd8" else None
+
+    flags = cv2.IMREAD_COLOR
+    if header_size:
+        longest = max(header_size)
+        for factor, reduced_flag in _REDUCED_FLAGS:
+            if longest // factor >= max_size:
+                flags = reduced_flag
+                break
+
+    image = cv2.imdecode(np_img, flags)
+    if image is None:
+        raise ValueError("Could not decode image")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    h, w = image.shape[:2]
+    if flags != cv2.IMREAD_COLOR:
+        # Report the full-resolution size; the decoder may have applied EXIF rotation
+        orig_w, orig_h = header_size
+        if (h > w) != (orig_h > orig_w):
+            orig_w, orig_h = orig_h, orig_w
+    else:
+        orig_w, orig_h = w, h
+
+    if max(h, w) > max_size:
+        scale = max_size / max(h, w)
+        image = cv2.resize(image, (int(w * scale), int(h * scale)))
+    return image, (orig_w, orig_h)
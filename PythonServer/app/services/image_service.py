@@ -0,0 +1,188 @@
+import os
+import cv2
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.services.image_io import read_image_size
+
+# Stay under SQLite's bound-parameter limit for IN (...) lookups
+_SQL_BATCH = 500
+
+class ImageService:
+    """Project image list stored as rows in the images table, ordered by `position`."""
+
+    def replace_images(self, conn, project_id: int, image_paths: Dict[str, str]) -> int:
+        """
+        Make the project's image list match image_paths ({name: path}, in display order).
+        Rows for unchanged paths keep their cached hash. Returns the image count.
+        """
+        image_paths = image_paths or {}
+        existing = {
+            r["name"]: (r["path"], r["position"])
+            for r in conn.execute("SELECT name, path, position FROM images WHERE project_id = ?", (project_id,))
+        }
+
+        removed = [(project_id, name) for name in existing if name not in image_paths]
+        if removed:
+            conn.executemany("DELETE FROM images WHERE project_id = ? AND name = ?", removed)
+
+        moved, added = [], []
+        for pos, (name, path) in enumerate(image_paths.items()):
+            current = existing.get(name)
+            if current is None:
+                added.append((project_id, name, path, pos, project_id, name))
+            elif current[0] != path:
+                # Different file under the same name: cached metadata no longer applies
+                conn.execute(
+                    '''UPDATE images SET path = ?, position = ?, content_hash = NULL
+                       WHERE project_id = ? AND name = ?''', (path, pos, project_id, name))
+            elif current[1] != pos:
+                moved.append((pos, project_id, name))
+        if moved:
+            conn.executemany("UPDATE images SET position = ? WHERE project_id = ? AND name = ?", moved)
+        if added:
+            conn.executemany(
+                '''INSERT INTO images (project_id, name, path, position, annotated)
+                   VALUES (?, ?, ?, ?, EXISTS (SELECT 1 FROM annotation_shapes WHERE project_id = ? AND image_name = ?))''',
+                added)
+        return len(image_paths)
+
+    def image_paths(self, conn, project_id: int) -> Dict[str, str]:
+        cursor = conn.execute("SELECT name, path FROM images WHERE project_id = ? ORDER BY position", (project_id,))
+        return {name: path for name, path in cursor}
+
+    def count(self, conn, project_id: int, annotated: Optional[bool] = None) -> int:
+        if annotated is None:
+            row = conn.execute("SELECT COUNT(*) FROM images WHERE project_id = ?", (project_id,)).fetchone()
+        else:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM images WHERE project_id = ? AND annotated = ?", (project_id, int(annotated))).fetchone()
+        return row[0]
+
+    def list_images(
+        self,
+        conn,
+        project_id: int,
+        offset: int = 0,
+        limit: int = 100,
+        annotated: Optional[bool] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        One page of the project's images in display order, optionally filtered by annotated state.
+        Dims come from the image_dims index and are None for images not measured yet.
+        """
+        query = '''SELECT i.name, i.path, i.position, d.width, d.height, i.content_hash, i.annotated
+                   FROM images i LEFT JOIN image_dims d ON d.path = i.path
+                   WHERE i.project_id = ?'''
+        params: list = [project_id]
+        if annotated is not None:
+            query += " AND i.annotated = ?"
+            params.append(int(annotated))
+        query += " ORDER BY i.position LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        return [
+            {
+                "name": r["name"],
+                "path": r["path"],
+                "index": r["position"],
+                "width": r["width"],
+                "height": r["height"],
+                "content_hash": r["content_hash"],
+                "annotated": bool(r["annotated"]),
+            }
+            for r in conn.execute(query, params)
+        ]
+
+    def neighbour_paths(self, conn, project_id: int, path: str, ahead: int, behind: int) -> Tuple[List[str], List[str]]:
+        """Paths of the images after (nearest first) and before (nearest first) the one at `path`."""
+        row = conn.execute("SELECT position FROM images WHERE project_id = ? AND path = ?", (project_id, path)).fetchone()
+        if row is None:
+            return [], []
+        after = conn.execute(
+            "SELECT path FROM images WHERE project_id = ? AND position > ? ORDER BY position LIMIT ?",
+            (project_id, row[0], ahead)).fetchall()
+        before = conn.execute(
+            "SELECT path FROM images WHERE project_id = ? AND position < ? ORDER BY position DESC LIMIT ?",
+            (project_id, row[0], behind)).fetchall()
+        return [r[0] for r in after], [r[0] for r in before]
+
+    def paths_for(self, conn, project_id: int, names: List[str]) -> Dict[str, str]:
+        """{name: path} for the given image names (names not in the project are left out)."""
+        paths = {}
+        for start in range(0, len(names), _SQL_BATCH):
+            chunk = names[start:start + _SQL_BATCH]
+            cursor = conn.execute(
+                f"SELECT name, path FROM images WHERE project_id = ? AND name IN ({','.join('?' * len(chunk))})",
+                [project_id, *chunk])
+            paths.update({name: path for name, path in cursor})
+        return paths
+
+    def get_dims(self, conn, paths: Iterable[str]) -> Dict[str, Optional[Tuple[int, int]]]:
+        """
+        (width, height) for each path, or None if the file is missing or unreadable. Served from the
+        image_dims index while the file's mtime and size match; otherwise the header is probed (no
+        pixel decode for JPEG/PNG/WebP/BMP) and the index updated; the caller commits.
+        """
+        paths = list(dict.fromkeys(p for p in paths if p))
+        cached = {}
+        for start in range(0, len(paths), _SQL_BATCH):
+            chunk = paths[start:start + _SQL_BATCH]
+            cursor = conn.execute(
+                f"SELECT path, mtime_ns, size, width, height FROM image_dims WHERE path IN ({','.join('?' * len(chunk))})",
+                chunk)
+            cached.update({r["path"]: r for r in cursor})
+
+        dims, probed = {}, []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                dims[path] = None
+                continue
+            row = cached.get(path)
+            if row is not None and row["mtime_ns"] == st.st_mtime_ns and row["size"] == st.st_size:
+                dims[path] = (row["width"], row["height"])
+                continue
+
+            size = self._measure(path)
+            dims[path] = size
+            if size:
+                probed.append((path, st.st_mtime_ns, st.st_size, size[0], size[1]))
+        if probed:
+            conn.executemany(
+                "INSERT OR REPLACE INTO image_dims (path, mtime_ns, size, width, height) VALUES (?, ?, ?, ?, ?)", probed)
+        return dims
+
+    @staticmethod
+    def _measure(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            size = read_image_size(path)
+            if size:
+                return size
+            # Format without a header parser: decode once, the result is cached like any other
+            img = cv2.imread(path)
+            return (img.shape[1], img.shape[0]) if img is not None else None
+        except (OSError, cv2.error):
+            return None
+
+    def record_load(
+        self, conn, project_id: int, name: str, path: str, width: int, height: int, content_hash: Optional[str]
+    ):
+        """
+        Cache what was learned when the image was opened for segmentation: the dims go to the
+        image_dims index that exports read, the content hash to the image row.
+        """
+        conn.execute(
+            "UPDATE images SET content_hash = COALESCE(?, content_hash) WHERE project_id = ? AND name = ?",
+            (content_hash, project_id, name))
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        conn.execute(
+            "INSERT OR REPLACE INTO image_dims (path, mtime_ns, size, width, height) VALUES (?, ?, ?, ?, ?)",
+            (path, st.st_mtime_ns, st.st_size, width, height))
+
+    def delete_project(self, conn, project_id: int):
+        conn.execute("DELETE FROM images WHERE project_id = ?", (project_id,))
+
+image_service = ImageService()
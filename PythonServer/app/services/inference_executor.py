@@ -0,0 +1,50 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+from app.core.config import get_settings
+
+class InferenceQueueFull(RuntimeError):
+    pass
+
+class InferenceExecutor:
+    """
+    Runs model work (decode + backbone) off the event loop on a dedicated thread pool.
+
+    Jobs are keyed: submitting a key that is already in flight awaits the running job
+    instead of queueing a duplicate. The number of queued + running jobs is bounded so a
+    burst of navigation cannot pile up minutes of encoder work.
+    """
+
+    def __init__(self):
+        settings = get_settings()
+        self.max_pending = settings.INFERENCE_QUEUE_SIZE
+        self.executor = ThreadPoolExecutor(max_workers=settings.INFERENCE_WORKERS, thread_name_prefix="inference")
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+
+    @property
+    def pending(self) -> int:
+        return len(self.inflight)
+
+    async def submit(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        # Only touched from the event loop thread, so no lock is needed around inflight
+        future = self.inflight.get(key)
+        if future is None:
+            if self.pending >= self.max_pending:
+                raise InferenceQueueFull("Inference queue is full, retry shortly")
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+            self.inflight[key] = future
+
+            def _release(done):
+                if self.inflight.get(key) is done:
+                    del self.inflight[key]
+            future.add_done_callback(_release)
+        # Shield so one client disconnecting does not cancel the job for the others awaiting it
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+inference_executor = InferenceExecutor()
@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import torch
+from typing import List, Dict, Any
+from sam2.utils.misc import mask_to_box
+
+# Douglas-Peucker tolerance as a fraction of the contour perimeter
+POLYGON_EPSILON_RATIO = 0.002
+
+def _simplify(contour: np.ndarray) -> List[Dict[str, int]]:
+    epsilon = POLYGON_EPSILON_RATIO * cv2.arcLength(contour, True)
+    approx = cv2.approxPolyDP(contour, epsilon, True)
+    return [{"x": int(p[0][0]), "y": int(p[0][1])} for p in approx]
+
+def masks_to_polygons(
+    masks: torch.Tensor,
+    multi_component: bool = False,
+    with_holes: bool = False,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Convert a BxHxW batch of binary masks (on any device) to polygons.
+
+    Boxes come from mask_to_box on the device, and only the ROI inside each box is copied
+    to host memory and contoured, so the cost scales with object size instead of image size.
+
+    Returns one list per mask of {"points": [...], "holes": [[...], ...]} components, largest
+    first. Without multi_component only the largest component is kept; without with_holes
+    the "holes" lists are empty.
+    """
+    if masks.dtype != torch.bool:
+        masks = masks > 0
+    boxes = mask_to_box(masks[:, None])[:, 0].cpu().numpy()
+
+    results = []
+    for mask, box in zip(masks, boxes):
+        x0, y0, x1, y1 = (int(v) for v in box)
+        if x1 < x0 or y1 < y0:  # Empty mask
+            results.append([])
+            continue
+        roi = mask[y0:y1 + 1, x0:x1 + 1].to(torch.uint8).cpu().numpy()
+
+        mode = cv2.RETR_CCOMP if with_holes else cv2.RETR_EXTERNAL
+        contours, hierarchy = cv2.findContours(roi, mode, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+        if not contours:
+            results.append([])
+            continue
+
+        # With RETR_CCOMP, top-level contours have parent -1 and their holes point back at them
+        parents = hierarchy[0][:, 3] if hierarchy is not None else np.full(len(contours), -1)
+        outer = [i for i in range(len(contours)) if parents[i] == -1]
+        outer.sort(key=lambda i: cv2.contourArea(contours[i]), reverse=True)
+        if not multi_component:
+            outer = outer[:1]
+
+        components = []
+        for i in outer:
+            holes = [_simplify(contours[j]) for j in range(len(contours)) if parents[j] == i] if with_holes else []
+            components.append({"points": _simplify(contours[i]), "holes": holes})
+        results.append(components)
+    return results
@@ -0,0 +1,72 @@
+import threading
+from typing import List, Optional
+
+from app.core.config import get_settings
+from app.core.database import get_db_connection
+from app.services.ai_service import ai_service
+from app.services.image_service import image_service
+
+class PrefetchService:
+    """
+    Background encoder that fills the embedding cache with the images around the
+    one the user is looking at. Every schedule() call bumps a generation counter,
+    which cancels whatever is still queued from the previous position.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.condition = threading.Condition()
+        self.queue: List[str] = []
+        self.generation = 0
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="embedding-prefetch", daemon=True)
+        self.thread.start()
+
+    def schedule(self, project_id: int, current_path: str):
+        """Queue the neighbours of current_path, nearest first, replacing any older schedule."""
+        ahead = self.settings.PREFETCH_AHEAD
+        behind = self.settings.PREFETCH_BEHIND
+        with get_db_connection() as conn:
+            after, before = image_service.neighbour_paths(conn, project_id, current_path, ahead, behind)
+        if not after and not before:
+            return
+
+        order = []
+        for step in range(max(len(after), len(before))):
+            if step < len(after):
+                order.append(after[step])
+            if step < len(before):
+                order.append(before[step])
+
+        with self.condition:
+            self.generation += 1
+            self.queue = order
+            self.condition.notify()
+        self.start()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.queue = []
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                path = self.queue.pop(0)
+                generation = self.generation
+
+            def is_cancelled():
+                return self.generation != generation
+
+            try:
+                ai_service.prefetch_path(path, is_cancelled)
+            except Exception as e:
+                print(f"Prefetch failed for {path}: {e}")
+
+prefetch_service = PrefetchService()
@@ -14,7 +14,7 @@ def clean_database():
         cursor = conn.cursor()
         
         # We assume tables exist since app creates them on startup
-        tables = ["projects", "project_state", "annotations_v2"]
+        tables = ["projects", "project_state", "annotation_shapes", "annotation_classes", "image_versions", "images", "image_dims", "export_jobs", "export_targets", "export_manifest", "project_stats", "project_class_stats"]
         
         for table in tables:
             try:
@@ -5,9 +5,10 @@ import sys
 # Add the current directory to sys.path so we can import 'app'
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-# Import the application instance
-from app.main import app
-
 if __name__ == "__main__":
+    # Imported here, not at module level: export worker processes are spawned and re-import
+    # this script, and must not load the app (and the SAM2 model) again
+    from app.main import app
+
     # Start the server
     uvicorn.run("app.main:app", host="127.0.0.1", port=8009, reload=False)
\ No newline at end of file
@@ -11,7 +11,6 @@ from pathlib import Path
 from threading import Lock
 from typing import Any, Dict, Generator, List
 
-import numpy as np
 import torch
 from app_conf import APP_ROOT, MODEL_SIZE
 from inference.data_types import (
@@ -33,8 +32,9 @@ from inference.data_types import (
     StartSessionRequest,
     StartSessionResponse,
 )
-from pycocotools.mask import decode as decode_masks, encode as encode_masks
+from pycocotools.mask import decode as decode_masks, frPyObjects
 from sam2.build_sam import build_sam2_video_predictor
+from sam2.utils.rle import masks_to_rle
 
 
 logger = logging.getLogger(__name__)
@@ -141,7 +141,7 @@ class InferenceAPI:
                 normalize_coords=False,
             )
 
-            masks_binary = (masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=object_ids, masks=masks_binary
@@ -181,7 +181,7 @@ class InferenceAPI:
                 obj_id=obj_id,
                 mask=torch.tensor(mask > 0),
             )
-            masks_binary = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=obj_ids, masks=masks_binary
@@ -213,7 +213,7 @@ class InferenceAPI:
                     inference_state, frame_idx, obj_id
                 )
             )
-            masks_binary = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+            masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
             rle_mask_list = self.__get_rle_mask_list(
                 object_ids=obj_ids, masks=masks_binary
@@ -254,7 +254,7 @@ class InferenceAPI:
 
             results = []
             for frame_index, video_res_masks in updated_frames:
-                masks = (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
+                masks = (video_res_masks > self.score_thresh)[:, 0]
                 rle_mask_list = self.__get_rle_mask_list(
                     object_ids=new_obj_ids, masks=masks
                 )
@@ -310,9 +310,7 @@ class InferenceAPI:
                             return None
 
                         frame_idx, obj_ids, video_res_masks = outputs
-                        masks_binary = (
-                            (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
-                        )
+                        masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
                         rle_mask_list = self.__get_rle_mask_list(
                             object_ids=obj_ids, masks=masks_binary
@@ -335,9 +333,7 @@ class InferenceAPI:
                             return None
 
                         frame_idx, obj_ids, video_res_masks = outputs
-                        masks_binary = (
-                            (video_res_masks > self.score_thresh)[:, 0].cpu().numpy()
-                        )
+                        masks_binary = (video_res_masks > self.score_thresh)[:, 0]
 
                         rle_mask_list = self.__get_rle_mask_list(
                             object_ids=obj_ids, masks=masks_binary
@@ -362,29 +358,35 @@ class InferenceAPI:
         return CancelPorpagateResponse(success=True)
 
     def __get_rle_mask_list(
-        self, object_ids: List[int], masks: np.ndarray
+        self, object_ids: List[int], masks: torch.Tensor
     ) -> List[PropagateDataValue]:
         """
         Return a list of data values, i.e. list of object/mask combos.
+
+        All masks are run-length encoded in one pass on their device, so only
+        the run boundaries are copied to the host, then compressed together.
         """
+        masks = torch.as_tensor(masks)
+        if masks.shape[0] == 0:
+            return []
+        h, w = masks.shape[-2:]
+        mask_rles = frPyObjects(masks_to_rle(masks), h, w)
         return [
-            self.__get_mask_for_object(object_id=object_id, mask=mask)
-            for object_id, mask in zip(object_ids, masks)
+            self.__get_mask_for_object(object_id=object_id, mask_rle=mask_rle)
+            for object_id, mask_rle in zip(object_ids, mask_rles)
         ]
 
     def __get_mask_for_object(
-        self, object_id: int, mask: np.ndarray
+        self, object_id: int, mask_rle: Dict[str, Any]
     ) -> PropagateDataValue:
         """
         Create a data value for an object/mask combo.
         """
-        mask_rle = encode_masks(np.array(mask, dtype=np.uint8, order="F"))
-        mask_rle["counts"] = mask_rle["counts"].decode()
         return PropagateDataValue(
             object_id=object_id,
             mask=Mask(
                 size=mask_rle["size"],
-                counts=mask_rle["counts"],
+                counts=mask_rle["counts"].decode(),
             ),
         )
 
@@ -5,11 +5,13 @@
 # LICENSE file in the root directory of this source tree.
 
 # Adapted from https://github.com/facebookresearch/segment-anything/blob/main/segment_anything/automatic_mask_generator.py
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
-from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
+from torchvision.ops.boxes import batched_nms, box_area, box_iou  # type: ignore
 
 from sam2.modeling.sam2_base import SAM2Base
 from sam2.sam2_image_predictor import SAM2ImagePredictor
@@ -25,12 +27,14 @@ from sam2.utils.amg import (
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
     MaskData,
-    remove_small_regions,
+    region_to_box,
+    remove_small_regions_in_box,
     rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
 )
+from sam2.utils.rle import rle_to_box, rles_to_masks
 
 
 class SAM2AutomaticMaskGenerator:
@@ -53,6 +57,8 @@ class SAM2AutomaticMaskGenerator:
         output_mode: str = "binary_mask",
         use_m2m: bool = False,
         multimask_output: bool = True,
+        low_res_filter: bool = False,
+        crops_per_batch: int = 4,
         **kwargs,
     ) -> None:
         """
@@ -101,6 +107,14 @@ class SAM2AutomaticMaskGenerator:
             memory.
           use_m2m (bool): Whether to add a one step refinement using previous mask predictions.
           multimask_output (bool): Whether to output multimask at each point of the grid.
+          low_res_filter (bool): Whether to filter by predicted IoU and stability
+            score on the low resolution logits, so that only surviving masks are
+            upsampled to the image resolution. Survivors are re-scored at full
+            resolution, so the output is a subset of what full resolution
+            filtering keeps. Ignored when use_m2m is set.
+          crops_per_batch (int): The number of crops of one crop layer embedded
+            together in a single backbone pass. Higher numbers may be faster
+            but use more memory.
         """
 
         assert (points_per_side is None) != (
@@ -148,6 +162,9 @@ class SAM2AutomaticMaskGenerator:
         self.output_mode = output_mode
         self.use_m2m = use_m2m
         self.multimask_output = multimask_output
+        self.low_res_filter = low_res_filter
+        self.crops_per_batch = crops_per_batch
+        self._image_features = None
 
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2AutomaticMaskGenerator":
@@ -166,6 +183,28 @@ class SAM2AutomaticMaskGenerator:
         sam_model = build_sam2_hf(model_id, **kwargs)
         return cls(sam_model, **kwargs)
 
+    def set_image_features(
+        self,
+        features: Optional[Dict[str, Any]],
+        orig_hw: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Supplies precomputed features for the full image, as held by
+        SAM2ImagePredictor._features after set_image. The uncropped layer
+        then decodes against them instead of running the image encoder again.
+        Crop layers are still embedded from the image itself.
+
+        Arguments:
+          features (dict or None): The predictor features for the full image,
+            or None to clear previously set features.
+          orig_hw (tuple(int, int)): The (H, W) of the image the features
+            were computed from.
+        """
+        if features is None:
+            self._image_features = None
+        else:
+            self._image_features = (features, tuple(orig_hw))
+
     @torch.no_grad()
     def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
         """
@@ -201,7 +240,7 @@ class SAM2AutomaticMaskGenerator:
                 coco_encode_rle(rle) for rle in mask_data["rles"]
             ]
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            mask_data["segmentations"] = list(rles_to_masks(mask_data["rles"]))
         else:
             mask_data["segmentations"] = mask_data["rles"]
 
@@ -221,33 +260,218 @@ class SAM2AutomaticMaskGenerator:
 
         return curr_anns
 
+    @torch.no_grad()
+    def generate_stream(
+        self,
+        image: Optional[np.ndarray] = None,
+        deadline: Optional[float] = None,
+        max_masks: Optional[int] = None,
+    ) -> Iterator[MaskData]:
+        """
+        Generates masks batch by batch, yielding each batch's masks as soon as
+        they pass filtering instead of returning them all at the end.
+
+        Duplicates are removed greedily: a mask is dropped if its box overlaps
+        a mask already yielded by more than box_nms_thresh (same crop) or
+        crop_nms_thresh (different crops). Unlike generate, a later mask with
+        a higher score cannot replace one that was already yielded.
+
+        Arguments:
+          image (np.ndarray or None): The image in HWC uint8 format. May be
+            None when features were supplied with set_image_features and
+            crop_n_layers is 0.
+          deadline (float or None): A time.monotonic() value after which no
+            further batch is started.
+          max_masks (int or None): Stop once this many masks were yielded.
+
+        Returns:
+          (iterator(MaskData)): Batches of masks with the keys rles, boxes
+            (XYXY), iou_preds, points, stability_score and crop_boxes, in
+            numpy format and in the original image frame.
+        """
+        if image is not None:
+            orig_size = image.shape[:2]
+        elif self._image_features is not None:
+            orig_size = self._image_features[1]
+        else:
+            raise ValueError("An image is required when no image features are set.")
+        crop_boxes, layer_idxs = generate_crop_boxes(
+            orig_size, self.crop_n_layers, self.crop_overlap_ratio
+        )
+        if image is None and len(crop_boxes) > 1:
+            raise ValueError("Crop layers require the image.")
+
+        kept = None
+        n_masks = 0
+        for layer_idx in sorted(set(layer_idxs)):
+            layer_boxes = [
+                box for box, idx in zip(crop_boxes, layer_idxs) if idx == layer_idx
+            ]
+            for crop_box, cropped_im_size, img_idx in self._bind_crops(
+                image, layer_boxes, orig_size
+            ):
+                points_scale = np.array(cropped_im_size)[None, ::-1]
+                points_for_image = self.point_grids[layer_idx] * points_scale
+                for (points,) in batch_iterator(
+                    self.points_per_batch, points_for_image
+                ):
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return
+                    data = self._process_batch(
+                        points,
+                        cropped_im_size,
+                        crop_box,
+                        orig_size,
+                        normalize=True,
+                        img_idx=img_idx,
+                    )
+                    del data["low_res_masks"]
+                    if len(data["rles"]) == 0:
+                        continue
+
+                    data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
+                    data["points"] = uncrop_points(data["points"], crop_box)
+                    data["crop_boxes"] = torch.tensor(
+                        [crop_box for _ in range(len(data["rles"]))],
+                        device=data["boxes"].device,
+                    )
+                    self._filter_streamed(data, kept)
+                    if len(data["rles"]) == 0:
+                        continue
+                    n_left = None if max_masks is None else max_masks - n_masks
+                    if n_left is not None and len(data["rles"]) > n_left:
+                        data.filter(torch.arange(n_left))
+
+                    batch_boxes = MaskData(
+                        boxes=data["boxes"], crop_boxes=data["crop_boxes"]
+                    )
+                    if kept is None:
+                        kept = batch_boxes
+                    else:
+                        kept.cat(batch_boxes)
+                    n_masks += len(data["rles"])
+                    data.to_numpy()
+                    yield data
+                    if max_masks is not None and n_masks >= max_masks:
+                        return
+
+    def _filter_streamed(self, data: MaskData, kept: Optional[MaskData]) -> None:
+        # Duplicates within the batch, leaving it sorted by predicted IoU
+        keep_by_nms = batched_nms(
+            data["boxes"].float(),
+            data["iou_preds"],
+            torch.zeros_like(data["boxes"][:, 0]),  # categories
+            iou_threshold=self.box_nms_thresh,
+        )
+        data.filter(keep_by_nms)
+        if kept is None or len(data["rles"]) == 0:
+            return
+
+        # Duplicates of masks already yielded
+        ious = box_iou(data["boxes"].float(), kept["boxes"].float())
+        same_crop = data["crop_boxes"][:, None, :] == kept["crop_boxes"][None, :, :]
+        same_crop = same_crop.all(-1)
+        thresh = torch.where(
+            same_crop,
+            torch.tensor(self.box_nms_thresh, device=ious.device),
+            torch.tensor(self.crop_nms_thresh, device=ious.device),
+        )
+        data.filter(~(ious > thresh).any(dim=1))
+
+    def _set_crop_image(
+        self,
+        image: Optional[np.ndarray],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ) -> Tuple[int, ...]:
+        # Bind the predictor to one crop and return the crop's size. The
+        # uncropped layer reuses features from set_image_features if present.
+        full_box = [0, 0, orig_size[1], orig_size[0]]
+        if (
+            self._image_features is not None
+            and list(crop_box) == full_box
+            and self._image_features[1] == tuple(orig_size)
+        ):
+            features, orig_hw = self._image_features
+            self.predictor._features = features
+            self.predictor._orig_hw = [orig_hw]
+            self.predictor._is_image_set = True
+            self.predictor._is_batch = False
+            return orig_hw
+
+        x0, y0, x1, y1 = crop_box
+        cropped_im = image[y0:y1, x0:x1, :]
+        self.predictor.set_image(cropped_im)
+        return cropped_im.shape[:2]
+
     def _generate_masks(self, image: np.ndarray) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
-
-        # Iterate over image crops
+        if len(crop_boxes) == 1:
+            data = self._process_crop(image, crop_boxes[0], layer_idxs[0], orig_size)
+            data.to_numpy()
+            return data
+
+        # Iterate over crop layers, embedding the crops of a layer in batches.
+        # Layers go from the smallest crops to the full image: crop NMS prefers
+        # masks from smaller crops, so everything kept so far outranks the next
+        # layer and duplicates can be removed as each layer is merged in.
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
-
-        # Remove duplicate masks between crops
-        if len(crop_boxes) > 1:
-            # Prefer masks from smaller crops
-            scores = 1 / box_area(data["crop_boxes"])
-            scores = scores.to(data["boxes"].device)
-            keep_by_nms = batched_nms(
-                data["boxes"].float(),
-                scores,
-                torch.zeros_like(data["boxes"][:, 0]),  # categories
-                iou_threshold=self.crop_nms_thresh,
-            )
-            data.filter(keep_by_nms)
+        for layer_idx in sorted(set(layer_idxs), reverse=True):
+            layer_boxes = [
+                box for box, idx in zip(crop_boxes, layer_idxs) if idx == layer_idx
+            ]
+            for crop_box, cropped_im_size, img_idx in self._bind_crops(
+                image, layer_boxes, orig_size
+            ):
+                crop_data = self._decode_crop(
+                    crop_box, layer_idx, cropped_im_size, orig_size, img_idx=img_idx
+                )
+                data.cat(crop_data)
+                del crop_data
+
+            # Remove duplicate masks between crops
+            if len(data["rles"]) > 0:
+                # Prefer masks from smaller crops
+                scores = 1 / box_area(data["crop_boxes"])
+                scores = scores.to(data["boxes"].device)
+                keep_by_nms = batched_nms(
+                    data["boxes"].float(),
+                    scores,
+                    torch.zeros_like(data["boxes"][:, 0]),  # categories
+                    iou_threshold=self.crop_nms_thresh,
+                )
+                data.filter(keep_by_nms)
         data.to_numpy()
         return data
 
+    def _bind_crops(
+        self,
+        image: Optional[np.ndarray],
+        crop_boxes: List[List[int]],
+        orig_size: Tuple[int, ...],
+    ) -> Iterator[Tuple[List[int], Tuple[int, ...], int]]:
+        # Yields (crop_box, cropped_im_size, img_idx) with the predictor bound
+        # to each crop in turn. Crops are embedded crops_per_batch at a time in
+        # one backbone pass.
+        for start in range(0, len(crop_boxes), self.crops_per_batch):
+            batch_boxes = crop_boxes[start : start + self.crops_per_batch]
+            if len(batch_boxes) == 1:
+                crop_sizes = [self._set_crop_image(image, batch_boxes[0], orig_size)]
+            else:
+                cropped_ims = [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in batch_boxes]
+                self.predictor.set_image_batch(cropped_ims)
+                crop_sizes = [cropped_im.shape[:2] for cropped_im in cropped_ims]
+            try:
+                for img_idx, (crop_box, cropped_im_size) in enumerate(
+                    zip(batch_boxes, crop_sizes)
+                ):
+                    yield crop_box, cropped_im_size, img_idx
+            finally:
+                self.predictor.reset_predictor()
+
     def _process_crop(
         self,
         image: np.ndarray,
@@ -256,11 +480,22 @@ class SAM2AutomaticMaskGenerator:
         orig_size: Tuple[int, ...],
     ) -> MaskData:
         # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        cropped_im_size = self._set_crop_image(image, crop_box, orig_size)
+        try:
+            return self._decode_crop(
+                crop_box, crop_layer_idx, cropped_im_size, orig_size
+            )
+        finally:
+            self.predictor.reset_predictor()
 
+    def _decode_crop(
+        self,
+        crop_box: List[int],
+        crop_layer_idx: int,
+        cropped_im_size: Tuple[int, ...],
+        orig_size: Tuple[int, ...],
+        img_idx: int = -1,
+    ) -> MaskData:
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
@@ -269,11 +504,15 @@ class SAM2AutomaticMaskGenerator:
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
             batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size, normalize=True
+                points,
+                cropped_im_size,
+                crop_box,
+                orig_size,
+                normalize=True,
+                img_idx=img_idx,
             )
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_predictor()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -298,8 +537,17 @@ class SAM2AutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
         normalize=False,
+        img_idx: int = -1,
     ) -> MaskData:
-        orig_h, orig_w = orig_size
+        if self.low_res_filter and not self.use_m2m:
+            return self._process_batch_low_res(
+                points,
+                im_size,
+                crop_box,
+                orig_size,
+                normalize=normalize,
+                img_idx=img_idx,
+            )
 
         # Run model on this batch
         points = torch.as_tensor(
@@ -316,6 +564,7 @@ class SAM2AutomaticMaskGenerator:
             in_labels[:, None],
             multimask_output=self.multimask_output,
             return_logits=True,
+            img_idx=img_idx,
         )
 
         # Serialize predictions and store in MaskData
@@ -349,7 +598,11 @@ class SAM2AutomaticMaskGenerator:
                 in_points.shape[0], dtype=torch.int, device=in_points.device
             )
             masks, ious = self.refine_with_m2m(
-                in_points, labels, data["low_res_masks"], self.points_per_batch
+                in_points,
+                labels,
+                data["low_res_masks"],
+                self.points_per_batch,
+                img_idx=img_idx,
             )
             data["masks"] = masks.squeeze(1)
             data["iou_preds"] = ious.squeeze(1)
@@ -365,6 +618,74 @@ class SAM2AutomaticMaskGenerator:
                 keep_mask = data["stability_score"] >= self.stability_score_thresh
                 data.filter(keep_mask)
 
+        return self._encode_batch(data, crop_box, orig_size)
+
+    def _process_batch_low_res(
+        self,
+        points: np.ndarray,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        normalize=False,
+        img_idx: int = -1,
+    ) -> MaskData:
+        # Run model on this batch, without upsampling
+        points = torch.as_tensor(
+            points, dtype=torch.float32, device=self.predictor.device
+        )
+        in_points = self.predictor._transforms.transform_coords(
+            points, normalize=normalize, orig_hw=im_size
+        )
+        in_labels = torch.ones(
+            in_points.shape[0], dtype=torch.int, device=in_points.device
+        )
+        _, iou_preds, low_res_masks = self.predictor._predict(
+            in_points[:, None, :],
+            in_labels[:, None],
+            multimask_output=self.multimask_output,
+            return_logits=True,
+            img_idx=img_idx,
+            upscale=False,
+        )
+        data = MaskData(
+            iou_preds=iou_preds.flatten(0, 1),
+            points=points.repeat_interleave(low_res_masks.shape[1], dim=0),
+            low_res_masks=low_res_masks.flatten(0, 1),
+        )
+
+        # Filter by predicted IoU and low res stability score
+        if self.pred_iou_thresh > 0.0:
+            keep_mask = data["iou_preds"] > self.pred_iou_thresh
+            data.filter(keep_mask)
+        if self.stability_score_thresh > 0.0:
+            keep_mask = (
+                calculate_stability_score(
+                    data["low_res_masks"],
+                    self.mask_threshold,
+                    self.stability_score_offset,
+                )
+                >= self.stability_score_thresh
+            )
+            data.filter(keep_mask)
+
+        # Upsample the survivors and score them at full resolution
+        data["masks"] = self.predictor._transforms.postprocess_masks(
+            data["low_res_masks"][:, None], im_size
+        )[:, 0]
+        data["stability_score"] = calculate_stability_score(
+            data["masks"], self.mask_threshold, self.stability_score_offset
+        )
+        if self.stability_score_thresh > 0.0:
+            keep_mask = data["stability_score"] >= self.stability_score_thresh
+            data.filter(keep_mask)
+
+        return self._encode_batch(data, crop_box, orig_size)
+
+    def _encode_batch(
+        self, data: MaskData, crop_box: List[int], orig_size: Tuple[int, ...]
+    ) -> MaskData:
+        orig_h, orig_w = orig_size
+
         # Threshold masks and calculate boxes
         data["masks"] = data["masks"] > self.mask_threshold
         data["boxes"] = batched_mask_to_box(data["masks"])
@@ -385,38 +706,45 @@ class SAM2AutomaticMaskGenerator:
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        num_workers: Optional[int] = None,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
         box NMS to remove any new duplicates.
 
+        Masks are processed in a thread pool of num_workers threads, and
+        connected components are labeled only inside each mask's box.
+
         Edits mask_data in place.
 
         Requires open-cv as a dependency.
         """
         if len(mask_data["rles"]) == 0:
             return mask_data
+        h, w = mask_data["rles"][0]["size"]
 
         # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
+        def clean(rle):
+            box = rle_to_box(rle)
+            region, window, changed = remove_small_regions_in_box(
+                rle_to_mask(rle), box, min_area
+            )
+            if not changed:
+                return None, None, box
+            return region, window, region_to_box(region, window)
 
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(clean, mask_data["rles"]))
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = [float(region is None) for region, _, _ in results]
+        boxes = torch.as_tensor([box for _, _, box in results], dtype=torch.int64)
 
-        # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        # Remove any new duplicates
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores),
@@ -424,17 +752,23 @@ class SAM2AutomaticMaskGenerator:
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+        # Only recalculate RLEs for masks that have changed, in one batch
+        changed = [int(i_mask) for i_mask in keep_by_nms if scores[i_mask] == 0.0]
+        if changed:
+            masks = torch.zeros((len(changed), h, w), dtype=torch.bool)
+            for j, i_mask in enumerate(changed):
+                region, (x0, y0, x1, y1), _ = results[i_mask]
+                masks[j, y0:y1, x0:x1] = torch.as_tensor(region)
+            for i_mask, rle in zip(changed, mask_to_rle_pytorch(masks)):
+                mask_data["rles"][i_mask] = rle
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
         return mask_data
 
-    def refine_with_m2m(self, points, point_labels, low_res_masks, points_per_batch):
+    def refine_with_m2m(
+        self, points, point_labels, low_res_masks, points_per_batch, img_idx=-1
+    ):
         new_masks = []
         new_iou_preds = []
 
@@ -447,6 +781,7 @@ class SAM2AutomaticMaskGenerator:
                 mask_input=low_res_mask[:, None, :],
                 multimask_output=False,
                 return_logits=True,
+                img_idx=img_idx,
             )
             new_masks.append(best_masks)
             new_iou_preds.append(best_iou_preds)
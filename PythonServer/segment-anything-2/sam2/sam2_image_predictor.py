@@ -343,7 +343,8 @@ class SAM2ImagePredictor:
         multimask_output: bool = True,
         return_logits: bool = False,
         img_idx: int = -1,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        upscale: bool = True,
+    ) -> Tuple[Optional[torch.Tensor], torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
         Input prompts are batched torch tensors and are expected to already be
@@ -369,9 +370,13 @@ class SAM2ImagePredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          upscale (bool): If false, skips upscaling to the original image
+            resolution and returns None for the output masks. The low res
+            logits are then returned unclamped, so upscaling them later gives
+            the same masks as upscale=True.
 
         Returns:
-          (torch.Tensor): The output masks in BxCxHxW format, where C is the
+          (torch.Tensor or None): The output masks in BxCxHxW format, where C is the
             number of masks, and (H, W) is the original image size.
           (torch.Tensor): An array of shape BxC containing the model's
             predictions for the quality of each mask.
@@ -427,6 +432,9 @@ class SAM2ImagePredictor:
             high_res_features=high_res_features,
         )
 
+        if not upscale:
+            return None, iou_predictions, low_res_masks
+
         # Upscale the masks to the original image resolution
         masks = self._transforms.postprocess_masks(
             low_res_masks, self._orig_hw[img_idx]
@@ -12,6 +12,8 @@ from typing import Any, Dict, Generator, ItemsView, List, Tuple
 import numpy as np
 import torch
 
+from sam2.utils.rle import masks_to_rle, rle_area, rle_to_mask  # noqa: F401
+
 # Very lightly adapted from https://github.com/facebookresearch/segment-anything/blob/main/segment_anything/utils/amg.py
 
 
@@ -111,48 +113,11 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     Encodes masks to an uncompressed RLE, in the format expected by
     pycoco tools.
     """
-    # Put in fortran order and flatten h,w
-    b, h, w = tensor.shape
-    tensor = tensor.permute(0, 2, 1).flatten(1)
-
-    # Compute change indices
-    diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
-
-
-def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
-    """Compute a binary mask from an uncompressed RLE."""
-    h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
-    mask = mask.reshape(w, h)
-    return mask.transpose()  # Put in C order
+    return masks_to_rle(tensor)
 
 
 def area_from_rle(rle: Dict[str, Any]) -> int:
-    return sum(rle["counts"][1::2])
+    return rle_area(rle)
 
 
 def calculate_stability_score(
@@ -293,6 +258,112 @@ def remove_small_regions(
     return mask, True
 
 
+def _outside_regions_at_least(
+    box: List[int], h: int, w: int, area_thresh: float
+) -> bool:
+    # Background outside a mask's box is one region, or two when the box spans
+    # the full width or height. Checks that none of them is a small region.
+    x0, y0, x1, y1 = box
+    top, bottom = y0 * w, (h - 1 - y1) * w
+    left, right = x0 * h, (w - 1 - x1) * h
+    if (top or bottom) and (left or right):
+        sizes = [h * w - (x1 - x0 + 1) * (y1 - y0 + 1)]
+    else:
+        sizes = [s for s in (top, bottom, left, right) if s]
+    return all(s >= area_thresh for s in sizes)
+
+
+def remove_small_regions_in_box(
+    mask: np.ndarray, box: List[int], area_thresh: float
+) -> Tuple[np.ndarray, List[int], bool]:
+    """
+    Same result as remove_small_regions in "holes" then "islands" mode, but
+    labels only the mask's box (XYXY, inclusive, as batched_mask_to_box gives
+    it) plus a one pixel margin. Falls back to the whole mask when it is empty
+    or background outside the box could itself be a small region.
+
+    Returns the processed region, the window [x0, y0, x1, y1) of the mask it
+    covers, and an indicator of if the mask has been modified.
+    """
+    import cv2  # type: ignore
+
+    h, w = mask.shape
+    x0, y0, x1, y1 = (int(v) for v in box)
+    if not mask[y0 : y1 + 1, x0 : x1 + 1].any() or not _outside_regions_at_least(
+        box, h, w, area_thresh
+    ):
+        mask, holes_changed = remove_small_regions(mask, area_thresh, mode="holes")
+        mask, islands_changed = remove_small_regions(mask, area_thresh, mode="islands")
+        return mask, [0, 0, w, h], holes_changed or islands_changed
+
+    wx0, wy0 = max(x0 - 1, 0), max(y0 - 1, 0)
+    wx1, wy1 = min(x1 + 2, w), min(y1 + 2, h)
+    region = mask[wy0:wy1, wx0:wx1]
+    changed = False
+
+    # Holes. Background touching the margin joins the background outside the
+    # box, which is not small, so it is never filled.
+    n_labels, regions, stats, _ = cv2.connectedComponentsWithStats(
+        (~region).astype(np.uint8), 8
+    )
+    small = np.concatenate([[False], stats[1:, -1] < area_thresh])
+    margins = []
+    if y0 > 0:
+        margins.append(regions[0])
+    if y1 < h - 1:
+        margins.append(regions[-1])
+    if x0 > 0:
+        margins.append(regions[:, 0])
+    if x1 < w - 1:
+        margins.append(regions[:, -1])
+    if margins:
+        small[np.concatenate(margins)] = False
+    if small.any():
+        region = region | small[regions]
+        changed = True
+
+    # Islands. Foreground lies inside the box, so labeling the window is exact.
+    n_labels, regions, stats, _ = cv2.connectedComponentsWithStats(
+        region.astype(np.uint8), 8
+    )
+    sizes = stats[1:, -1]
+    small = sizes < area_thresh
+    if small.all() and (sizes == sizes.max()).sum() > 1:
+        # Which of the tied largest regions is kept depends on label order,
+        # which depends on the window, so label the whole mask instead
+        mask = mask.copy()
+        mask[wy0:wy1, wx0:wx1] = region
+        mask, _ = remove_small_regions(mask, area_thresh, mode="islands")
+        return mask, [0, 0, w, h], True
+    if small.any():
+        keep = ~small
+        # If every region is below threshold, keep largest
+        if not keep.any():
+            keep[int(np.argmax(sizes))] = True
+        region = np.concatenate([[False], keep])[regions]
+        changed = True
+
+    return region, [wx0, wy0, wx1, wy1], changed
+
+
+def region_to_box(region: np.ndarray, window: List[int]) -> List[int]:
+    """
+    XYXY box around a mask region whose window starts at window[:2], in the
+    full mask's coordinates, as batched_mask_to_box computes it.
+    """
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    if len(rows) == 0:
+        return [0, 0, 0, 0]
+    x0, y0 = window[0], window[1]
+    return [
+        x0 + int(cols[0]),
+        y0 + int(rows[0]),
+        x0 + int(cols[-1]),
+        y0 + int(rows[-1]),
+    ]
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
@@ -0,0 +1,182 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Batched run-length encoding of binary masks.
+
+RLEs are uncompressed and in the format pycocotools expects: a dict with
+"size" [h, w] and "counts", the lengths of alternating runs of 0s and 1s over
+the mask in column-major order, starting with a (possibly empty) run of 0s.
+Area, box, merge and IoU are computed on the runs without decoding masks.
+"""
+
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+def masks_to_rle(masks: torch.Tensor) -> List[Dict[str, Any]]:
+    """
+    Encodes a BxHxW batch of binary masks to uncompressed RLEs. The change
+    points of all masks are found in one pass on the masks' device, and only
+    those are copied to the host.
+    """
+    b, h, w = masks.shape
+    n = h * w
+    if b == 0:
+        return []
+    flat = masks.bool().permute(0, 2, 1).flatten(1)  # Fortran order
+
+    change = (flat[:, 1:] ^ flat[:, :-1]).nonzero()  # Row-major, so grouped by mask
+    starts_with_one = flat[:, 0].cpu().numpy()
+    change = change.cpu().numpy()
+    rows, positions = change[:, 0], change[:, 1] + 1
+
+    # Lay out [0, changes..., n] for every mask back to back and take differences
+    n_changes = np.bincount(rows, minlength=b)
+    offsets = np.concatenate([[0], np.cumsum(n_changes + 2)])
+    seg_starts, seg_ends = offsets[:-1], offsets[1:] - 1
+    bounds = np.empty(offsets[-1], dtype=np.int64)
+    is_change = np.ones(offsets[-1], dtype=bool)
+    is_change[seg_starts] = False
+    is_change[seg_ends] = False
+    bounds[seg_starts] = 0
+    bounds[seg_ends] = n
+    bounds[is_change] = positions
+    runs = np.diff(bounds)
+
+    out = []
+    for i in range(b):
+        counts = [0] if starts_with_one[i] else []
+        counts.extend(runs[seg_starts[i] : seg_ends[i]].tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+
+def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
+    """Decodes an uncompressed RLE to an HxW boolean mask."""
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = (np.arange(len(counts)) % 2).astype(bool)
+    mask = np.repeat(values, counts)
+    return mask.reshape(w, h).transpose()  # Put in C order
+
+
+def rles_to_masks(rles: Sequence[Dict[str, Any]]) -> np.ndarray:
+    """Decodes RLEs of the same size to an NxHxW boolean array."""
+    if len(rles) == 0:
+        return np.zeros((0, 0, 0), dtype=bool)
+    h, w = rles[0]["size"]
+    out = np.empty((len(rles), w, h), dtype=bool)
+    for i, rle in enumerate(rles):
+        counts = np.asarray(rle["counts"], dtype=np.int64)
+        values = (np.arange(len(counts)) % 2).astype(bool)
+        out[i] = np.repeat(values, counts).reshape(w, h)
+    return out.transpose(0, 2, 1)
+
+
+def rle_foreground_runs(rle: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the start and end (exclusive) of each run of 1s, as indices into
+    the column-major flattened mask.
+    """
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    n = len(counts)
+    return bounds[1:n:2], bounds[2 : n + 1 : 2]
+
+
+def runs_to_rle(
+    starts: np.ndarray, ends: np.ndarray, size: Sequence[int]
+) -> Dict[str, Any]:
+    """Builds an RLE from sorted, disjoint runs of 1s."""
+    h, w = size
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    prev_ends = np.concatenate([[0], ends[:-1]])
+    counts = np.stack([starts - prev_ends, ends - starts], axis=1).ravel().tolist()
+    tail = h * w - (int(ends[-1]) if len(ends) else 0)
+    if tail > 0 or not counts:
+        counts.append(tail)
+    return {"size": [h, w], "counts": counts}
+
+
+def rle_area(rle: Dict[str, Any]) -> int:
+    return int(sum(rle["counts"][1::2]))
+
+
+def rle_to_box(rle: Dict[str, Any]) -> List[int]:
+    """
+    Box around the mask in XYXY format with inclusive max coordinates, as
+    batched_mask_to_box computes it. Returns [0, 0, 0, 0] for an empty mask.
+    """
+    h, _ = rle["size"]
+    starts, ends = rle_foreground_runs(rle)
+    nonempty = ends > starts
+    starts, last = starts[nonempty], ends[nonempty] - 1
+    if len(starts) == 0:
+        return [0, 0, 0, 0]
+    col_s, row_s = np.divmod(starts, h)
+    col_e, row_e = np.divmod(last, h)
+    # A run that wraps to the next column covers the bottom and top rows
+    same_col = col_s == col_e
+    y0 = int(np.where(same_col, row_s, 0).min())
+    y1 = int(np.where(same_col, row_e, h - 1).max())
+    return [int(col_s[0]), y0, int(col_e[-1]), y1]
+
+
+def merge_rles(rles: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """The union of RLEs of the same size, as an RLE."""
+    size = rles[0]["size"]
+    runs = [rle_foreground_runs(rle) for rle in rles]
+    starts = np.concatenate([s for s, _ in runs])
+    ends = np.concatenate([e for _, e in runs])
+    if len(starts) == 0:
+        return runs_to_rle(starts, ends, size)
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+
+    # A run starts a new merged run unless it overlaps or touches everything before it
+    reach = np.maximum.accumulate(ends)
+    new_run = np.concatenate([[True], starts[1:] > reach[:-1]])
+    first = np.flatnonzero(new_run)
+    last = np.concatenate([first[1:], [len(starts)]]) - 1
+    return runs_to_rle(starts[first], reach[last], size)
+
+
+def _covered(starts: np.ndarray, ends: np.ndarray, x: np.ndarray) -> np.ndarray:
+    # Number of foreground pixels before each index x, for sorted disjoint runs
+    lengths = ends - starts
+    before = np.concatenate([[0], np.cumsum(lengths)])
+    idx = np.searchsorted(starts, x, side="right") - 1
+    safe = np.maximum(idx, 0)
+    partial = np.minimum(x - starts[safe], lengths[safe])
+    return np.where(idx >= 0, before[safe] + partial, 0)
+
+
+def rle_intersection(a: Dict[str, Any], b: Dict[str, Any]) -> int:
+    """Number of pixels set in both RLEs."""
+    a_starts, a_ends = rle_foreground_runs(a)
+    b_starts, b_ends = rle_foreground_runs(b)
+    if len(a_starts) == 0 or len(b_starts) == 0:
+        return 0
+    covered = _covered(a_starts, a_ends, b_ends) - _covered(a_starts, a_ends, b_starts)
+    return int(covered.sum())
+
+
+def rle_iou(
+    rles_a: Sequence[Dict[str, Any]], rles_b: Sequence[Dict[str, Any]]
+) -> np.ndarray:
+    """Pairwise mask IoU between two lists of RLEs, as a len(a) x len(b) array."""
+    areas_a = np.array([rle_area(r) for r in rles_a], dtype=np.float64)
+    areas_b = np.array([rle_area(r) for r in rles_b], dtype=np.float64)
+    inter = np.zeros((len(rles_a), len(rles_b)), dtype=np.float64)
+    for i, a in enumerate(rles_a):
+        for j, b in enumerate(rles_b):
+            inter[i, j] = rle_intersection(a, b)
+    union = areas_a[:, None] + areas_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1), 0.0)
@@ -0,0 +1,69 @@
+import importlib.util
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAM2_DIR = os.path.join(SERVER_DIR, "segment-anything-2", "sam2")
+sys.path.insert(0, SERVER_DIR)
+
+from app.core.config import get_settings
+from app.core import database
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A fresh database file for the test; the pooled connections are reopened against it."""
+    settings = get_settings()
+    saved = settings.DB_PATH, settings.EXPORT_DIR
+    settings.DB_PATH = str(tmp_path / "test.db")
+    settings.EXPORT_DIR = str(tmp_path / "exports")
+    database.close_all_connections()
+    database.init_db()
+    yield settings
+    database.close_all_connections()
+    settings.DB_PATH, settings.EXPORT_DIR = saved
+
+
+@pytest.fixture
+def project(db):
+    with database.get_db_connection() as conn:
+        cursor = conn.execute("INSERT INTO projects (name, folder_path) VALUES ('test', '/tmp')")
+        conn.execute("INSERT INTO project_state (project_id, categories) VALUES (?, ?)",
+                     (cursor.lastrowid, '[{"name": "cat"}, {"name": "dog"}]'))
+        return cursor.lastrowid
+
+
+def _load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def sam2_utils():
+    """
+    sam2.utils.rle and sam2.utils.amg loaded from their files, so the sam2 package __init__
+    (hydra) is not needed. Without torch a placeholder module is used while loading; only the
+    numpy code paths are usable then, and tests of torch code paths skip.
+    """
+    try:
+        import torch
+        has_torch = True
+    except ImportError:
+        torch = types.ModuleType("torch")
+        torch.Tensor = object
+        has_torch = False
+    sam2 = types.ModuleType("sam2")
+    sam2.__path__ = [SAM2_DIR]
+    utils = types.ModuleType("sam2.utils")
+    utils.__path__ = [os.path.join(SAM2_DIR, "utils")]
+    with mock.patch.dict(sys.modules, {"torch": torch, "sam2": sam2, "sam2.utils": utils}):
+        rle = _load("sam2.utils.rle", os.path.join(SAM2_DIR, "utils", "rle.py"))
+        amg = _load("sam2.utils.amg", os.path.join(SAM2_DIR, "utils", "amg.py"))
+    return types.SimpleNamespace(rle=rle, amg=amg, has_torch=has_torch)
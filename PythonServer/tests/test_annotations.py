@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+from app.core.database import get_db_connection, rebuild_project_stats
+from app.services.annotation_service import annotation_service
+
+
+def shape(class_name, x=0, size=10):
+    return {
+        "className": class_name,
+        "points": [{"x": x, "y": 0}, {"x": x + size, "y": 0}, {"x": x + size, "y": size}, {"x": x, "y": size}],
+    }
+
+
+def load(project_id, image_name):
+    """Stored shapes without their row ids."""
+    shapes, _ = annotation_service.load_annotations(project_id, image_name)
+    return [{k: v for k, v in a.items() if k != "id"} for a in shapes]
+
+
+def test_round_trip_keeps_points_and_extra_keys(project):
+    annotations = [
+        shape("cat"),
+        {"className": "dog", "points": [{"x": 1.5, "y": 2.25}, {"x": 10.125, "y": 3}, {"x": 4, "y": 8.5}],
+         "color": "#ff0000", "visible": False},
+    ]
+    annotation_service.save_annotations(project, "a.png", annotations)
+    loaded = load(project, "a.png")
+    assert loaded == annotations
+    assert all(isinstance(p["x"], int) for p in loaded[0]["points"])  # Integral points stay ints
+
+
+def test_shape_without_class_round_trips_without_class_key(project):
+    annotations = [{"points": shape("cat")["points"]}]
+    annotation_service.save_annotations(project, "a.png", annotations)
+    assert load(project, "a.png") == annotations
+
+
+def test_save_rewrites_only_changed_rows(project):
+    annotations = [shape("cat"), shape("dog", x=20), shape("cat", x=40)]
+    annotation_service.save_annotations(project, "a.png", annotations)
+    with get_db_connection() as conn:
+        before = {r[0]: r[1] for r in conn.execute("SELECT shape_index, id FROM annotation_shapes")}
+
+    annotations[1] = shape("cat", x=25)
+    annotation_service.save_annotations(project, "a.png", annotations[:2])
+    with get_db_connection() as conn:
+        after = {r[0]: r[1] for r in conn.execute("SELECT shape_index, id FROM annotation_shapes")}
+    assert after == {0: before[0], 1: before[1]}  # Updated in place, the last row deleted
+    assert load(project, "a.png") == annotations[:2]
+
+
+def test_images_are_independent(project):
+    annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    annotation_service.save_annotations(project, "b.png", [shape("dog"), shape("dog", x=20)])
+    annotation_service.save_annotations(project, "a.png", [])
+    assert load(project, "a.png") == []
+    assert [a["className"] for a in load(project, "b.png")] == ["dog", "dog"]
+
+
+def test_delta_applies_on_current_version(project):
+    saved = annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    assert saved["version"] == 1
+
+    result = annotation_service.apply_delta(project, "a.png", 1, added=[shape("dog", x=20)])
+    assert result["status"] == "success"
+    assert result["version"] == 2
+    annotations, version = annotation_service.load_annotations(project, "a.png")
+    assert version == 2
+    assert [a["className"] for a in annotations] == ["cat", "dog"]
+
+
+def test_delta_on_stale_version_conflicts_without_writing(project):
+    saved = annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    annotation_service.apply_delta(project, "a.png", saved["version"], added=[shape("dog")])
+
+    stale = annotation_service.apply_delta(
+        project, "a.png", saved["version"], added=[shape("cat", x=50)], deleted=[saved["ids"][0]])
+    assert stale["conflict"] is True
+    assert stale["version"] == 2
+    annotations, version = annotation_service.load_annotations(project, "a.png")
+    assert version == 2
+    assert [a["className"] for a in annotations] == ["cat", "dog"]
+
+
+def test_first_delta_needs_base_version_zero(project):
+    assert annotation_service.apply_delta(project, "new.png", 3, added=[shape("cat")])["conflict"] is True
+    assert annotation_service.apply_delta(project, "new.png", 0, added=[shape("cat")])["version"] == 1
+    # A second writer that also started from an unsaved image loses
+    assert annotation_service.apply_delta(project, "new.png", 0, added=[shape("dog")])["conflict"] is True
+    annotations, _ = annotation_service.load_annotations(project, "new.png")
+    assert len(annotations) == 1
+
+
+def test_unchanged_save_keeps_version(project):
+    annotations = [shape("cat"), shape("dog", x=20)]
+    assert annotation_service.save_annotations(project, "a.png", annotations)["version"] == 1
+    assert annotation_service.save_annotations(project, "a.png", annotations)["version"] == 1
+    assert annotation_service.save_annotations(project, "a.png", annotations[:1])["version"] == 2
+
+
+def stats_snapshot(conn, project_id):
+    stats = annotation_service.project_stats(conn, project_id)
+    classes = {
+        r[0]: (r[1], round(r[2], 6)) for r in conn.execute(
+            "SELECT class_id, instance_count, total_area FROM project_class_stats WHERE project_id = ? AND instance_count > 0",
+            (project_id,))
+    }
+    stats["total_area"] = round(stats["total_area"], 6)
+    return stats, classes
+
+
+def test_stats_triggers_match_rebuild(project):
+    pytest.importorskip("cv2")
+    from app.services.image_service import image_service
+
+    with get_db_connection() as conn:
+        total = image_service.replace_images(conn, project, {f"{i}.png": f"/tmp/{i}.png" for i in range(6)})
+        annotation_service.set_total_images(conn, project, total)  # As saving the project state does
+
+    rng = np.random.default_rng(0)
+    for step in range(60):
+        name = f"{rng.integers(0, 6)}.png"
+        current, version = annotation_service.load_annotations(project, name)
+        op = step % 3
+        if op == 0:
+            count = int(rng.integers(0, 4))
+            annotations = [shape(str(rng.choice(["cat", "dog", "bird"])), x=int(rng.integers(0, 50)),
+                                 size=int(rng.integers(1, 20))) for _ in range(count)]
+            annotation_service.save_annotations(project, name, annotations)
+        elif op == 1 and current:
+            changed = dict(current[0], className="bird", points=shape("bird", size=int(rng.integers(1, 9)))["points"])
+            annotation_service.apply_delta(project, name, version, modified=[changed], deleted=[a["id"] for a in current[1:2]])
+        else:
+            annotation_service.apply_delta(project, name, version, added=[shape("cat", size=int(rng.integers(1, 9)))])
+
+        with get_db_connection() as conn:
+            incremental = stats_snapshot(conn, project)
+            annotated = {r[0] for r in conn.execute(
+                "SELECT name FROM images WHERE project_id = ? AND annotated = 1", (project,))}
+            expected_annotated = {r[0] for r in conn.execute(
+                "SELECT DISTINCT image_name FROM annotation_shapes WHERE project_id = ?", (project,))}
+            rebuild_project_stats(conn)
+            rebuilt = stats_snapshot(conn, project)
+            conn.rollback()  # Keep the trigger-maintained rows for the next step
+        assert incremental == rebuilt
+        assert annotated == expected_annotated
@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+from app.services import autosave_service as autosave_module
+from app.services.annotation_service import annotation_service
+from app.services.autosave_service import AutosaveService
+
+from test_annotations import shape
+
+
+@pytest.fixture
+def autosave(project, monkeypatch):
+    # A long window keeps the background thread out of the way; the tests flush explicitly
+    monkeypatch.setattr(autosave_module.get_settings(), "AUTOSAVE_WINDOW_MS", 60_000)
+    service = AutosaveService()
+    yield service
+    service.shutdown()
+
+
+def test_flush_writes_coalesced_saves(autosave, project):
+    autosave.enqueue(project, "a.png", [shape("cat")])
+    autosave.enqueue(project, "a.png", [shape("cat"), shape("dog", x=20)])
+    autosave.enqueue(project, "b.png", [shape("dog")])
+    assert annotation_service.load_annotations(project, "a.png") == ([], 0)
+
+    assert autosave.flush(project, "a.png") == 1
+    annotations, version = annotation_service.load_annotations(project, "a.png")
+    assert [a["className"] for a in annotations] == ["cat", "dog"]
+    assert version == 1
+    assert autosave.stats()["queue_depth"] == 1
+
+    assert autosave.flush(project) == 1
+    assert autosave.stats()["coalesced"] == 1
+    assert autosave.stats()["images_written"] == 2
+
+
+@pytest.mark.parametrize("annotations", [
+    "not a list",
+    [["not", "a", "dict"]],
+    [{"className": "cat", "points": [{"x": 1}]}],
+])
+def test_enqueue_rejects_malformed_payload(autosave, project, annotations):
+    with pytest.raises(ValueError):
+        autosave.enqueue(project, "a.png", annotations)
+    assert autosave.stats()["queue_depth"] == 0
+
+
+def test_failing_image_is_dropped_and_the_rest_written(autosave, project, monkeypatch):
+    write = annotation_service.write_annotations
+
+    def fail_on_b(conn, project_id, image_name, annotations):
+        result = write(conn, project_id, image_name, annotations)
+        if image_name == "b.png":
+            raise TypeError("bad payload")  # After writing, so the savepoint rollback is exercised
+        return result
+
+    monkeypatch.setattr(annotation_service, "write_annotations", fail_on_b)
+    for name in ("a.png", "b.png", "c.png"):
+        autosave.enqueue(project, name, [shape("cat")])
+
+    assert autosave.flush(project) == 2
+    assert autosave.stats()["queue_depth"] == 0
+    assert autosave.stats()["dropped"] == 1
+    assert "b.png" in autosave.stats()["last_error"]
+    assert annotation_service.load_annotations(project, "b.png") == ([], 0)
+    for name in ("a.png", "c.png"):
+        assert len(annotation_service.load_annotations(project, name)[0]) == 1
+
+
+def test_database_error_requeues_without_raising(autosave, project, monkeypatch):
+    write = annotation_service.write_annotations
+
+    def locked(conn, project_id, image_name, annotations):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(annotation_service, "write_annotations", locked)
+    autosave.enqueue(project, "a.png", [shape("cat")])
+    assert autosave.flush(project) == 0
+    assert autosave.stats()["queue_depth"] == 1
+    assert autosave.stats()["errors"] == 1
+
+    monkeypatch.setattr(annotation_service, "write_annotations", write)
+    assert autosave.flush(project) == 1
+    assert len(annotation_service.load_annotations(project, "a.png")[0]) == 1
+
+
+def test_shutdown_drains_pending(autosave, project):
+    autosave.enqueue(project, "a.png", [shape("cat")])
+    autosave.shutdown()
+    assert len(annotation_service.load_annotations(project, "a.png")[0]) == 1
@@ -0,0 +1,113 @@
+import os
+import struct
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from app.services.image_io import probe_image_size, read_image_size
+
+
+def write_image(path, w, h, params=()):
+    image = np.random.default_rng(0).integers(0, 255, (h, w, 3), dtype=np.uint8)
+    assert cv2.imwrite(str(path), image, list(params))
+    return str(path)
+
+
+def with_exif_orientation(jpeg: bytes, orientation: int) -> bytes:
+    """Insert an APP1 Exif segment holding only the orientation tag right after SOI."""
+    ifd = struct.pack("<H", 1) + struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0) + struct.pack("<I", 0)
+    tiff = b"II" + struct.pack("<HI", 42, 8) + ifd
+    payload = b"Exif\x00\x00" + tiff
+    return jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload + jpeg[2:]
+
+
+@pytest.fixture
+def no_decode(monkeypatch):
+    """Fail the test if anything decodes pixels."""
+    def fail(*args, **kwargs):
+        raise AssertionError("pixels were decoded")
+    monkeypatch.setattr(cv2, "imread", fail)
+    monkeypatch.setattr(cv2, "imdecode", fail)
+
+
+@pytest.mark.parametrize("ext,params", [
+    (".jpg", ()),
+    (".jpg", (cv2.IMWRITE_JPEG_PROGRESSIVE, 1)),
+    (".png", ()),
+    (".bmp", ()),
+    (".webp", (cv2.IMWRITE_WEBP_QUALITY, 80)),
+    (".webp", (cv2.IMWRITE_WEBP_QUALITY, 101)),  # Lossless
+])
+def test_header_probe_matches_decode(tmp_path, ext, params):
+    path = write_image(tmp_path / f"image{ext}", 37, 21, params)
+    image = cv2.imread(path)
+    expected = (image.shape[1], image.shape[0])
+    with open(path, "rb") as f:
+        assert probe_image_size(f.read()) == expected
+    assert read_image_size(path) == expected
+
+
+def test_read_image_size_does_not_decode(tmp_path, no_decode):
+    path = str(tmp_path / "image.png")
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 640, 480) + b"\x08\x02\x00\x00\x00")
+    assert read_image_size(path) == (640, 480)
+
+
+@pytest.mark.parametrize("orientation", [1, 3, 6, 8])
+def test_jpeg_exif_orientation_matches_imread(tmp_path, orientation):
+    path = write_image(tmp_path / "plain.jpg", 40, 24)
+    with open(path, "rb") as f:
+        data = with_exif_orientation(f.read(), orientation)
+    rotated = str(tmp_path / "rotated.jpg")
+    with open(rotated, "wb") as f:
+        f.write(data)
+
+    image = cv2.imread(rotated)
+    assert read_image_size(rotated) == (image.shape[1], image.shape[0])
+    assert read_image_size(rotated) == ((24, 40) if orientation in (6, 8) else (40, 24))
+
+
+def test_jpeg_sof_after_large_exif(tmp_path):
+    # An EXIF block larger than the first header read pushes the SOF marker back
+    path = write_image(tmp_path / "plain.jpg", 33, 17)
+    with open(path, "rb") as f:
+        jpeg = f.read()
+    payload = b"Exif\x00\x00" + b"\x00" * 60000
+    big = jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(payload) + 2) + payload + jpeg[2:]
+    padded = str(tmp_path / "padded.jpg")
+    with open(padded, "wb") as f:
+        f.write(big)
+    assert read_image_size(padded) == (33, 17)
+
+
+def test_unknown_format(tmp_path):
+    path = tmp_path / "image.xyz"
+    path.write_bytes(b"not an image at all" * 4)
+    assert read_image_size(str(path)) is None
+
+
+def test_get_dims_serves_index_until_file_changes(db, tmp_path, monkeypatch):
+    from app.core.database import get_db_connection
+    from app.services.image_service import image_service
+
+    path = write_image(tmp_path / "a.png", 30, 20)
+    missing = str(tmp_path / "missing.png")
+    with get_db_connection() as conn:
+        assert image_service.get_dims(conn, [path, missing]) == {path: (30, 20), missing: None}
+
+    probes = []
+    real_measure = image_service._measure
+    monkeypatch.setattr(image_service, "_measure", lambda p: probes.append(p) or real_measure(p))
+    with get_db_connection() as conn:
+        assert image_service.get_dims(conn, [path]) == {path: (30, 20)}
+    assert probes == []  # Served from the index
+
+    write_image(tmp_path / "a.png", 50, 10)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    with get_db_connection() as conn:
+        assert image_service.get_dims(conn, [path]) == {path: (50, 10)}
+    assert probes == [path]
@@ -0,0 +1,134 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip("cv2")
+
+from app.core.database import get_db_connection
+from app.services.annotation_service import annotation_service
+from app.services.export_service import export_service
+from app.services.image_service import image_service
+
+from test_annotations import shape
+
+
+@pytest.fixture
+def images(project, tmp_path):
+    folder = tmp_path / "images"
+    folder.mkdir()
+    paths = {}
+    for name in ("a.png", "b.png", "c.png"):
+        paths[name] = str(folder / name)
+        cv2.imwrite(paths[name], np.zeros((40, 60, 3), dtype=np.uint8))
+    with get_db_connection() as conn:
+        image_service.replace_images(conn, project, paths)
+    return paths
+
+
+def export(project_id, format="yolo"):
+    progress = []
+    result = export_service.export_project(
+        project_id, format, incremental=True, progress=lambda done, total: progress.append((done, total)))
+    assert result["status"] == "success", result
+    return result, progress
+
+
+def manifest(project_id, format="yolo"):
+    with get_db_connection() as conn:
+        return {r[0]: tuple(r[1:]) for r in conn.execute(
+            "SELECT image_name, version, width, height FROM export_manifest WHERE project_id = ? AND format = ?",
+            (project_id, format))}
+
+
+def test_only_changed_images_are_rewritten(project, images):
+    for name in ("a.png", "b.png", "c.png"):
+        annotation_service.save_annotations(project, name, [shape("cat")])
+
+    result, progress = export(project)
+    assert result["rebuilt"] and result["written"] == 3
+    assert manifest(project) == {name: (1, 60, 40) for name in images}
+    out_dir = result["path"]
+    assert sorted(os.listdir(out_dir)) == ["a.txt", "b.txt", "c.txt"]
+
+    result, progress = export(project)
+    assert not result["rebuilt"]
+    assert result["written"] == 0 and result["removed"] == 0
+    assert progress[-1] == (0, 0)
+
+    annotation_service.save_annotations(project, "b.png", [shape("cat"), shape("dog", x=20)])
+    result, progress = export(project)
+    assert result["written"] == 1
+    assert progress[0] == (0, 1) and progress[-1] == (1, 1)  # Sized by the changed images only
+    assert manifest(project)["b.png"] == (2, 60, 40)
+    with open(os.path.join(out_dir, "b.txt")) as f:
+        assert len(f.read().splitlines()) == 2
+
+
+def test_cleared_annotations_remove_output(project, images):
+    for name in ("a.png", "b.png"):
+        annotation_service.save_annotations(project, name, [shape("cat")])
+    result, _ = export(project)
+
+    annotation_service.save_annotations(project, "a.png", [])
+    result, _ = export(project)
+    assert result["written"] == 1 and result["removed"] == 0  # Still a saved image, now without labels
+    assert sorted(os.listdir(result["path"])) == ["b.txt"]
+    assert manifest(project)["a.png"] == (2, 60, 40)
+
+
+def test_images_saved_empty_are_exported(project, images):
+    annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    annotation_service.save_annotations(project, "b.png", [])
+
+    result, progress = export(project, "masks")
+    assert sorted(os.listdir(result["path"])) == ["a.png", "b.png"]
+    assert progress[-1] == (2, 2)
+
+    progress = []
+    result = export_service.export_project(project, "coco", progress=lambda done, total: progress.append((done, total)))
+    with open(os.path.join(result["path"], "annotations.json")) as f:
+        coco = json.load(f)
+    assert [img["file_name"] for img in coco["images"]] == ["a.png", "b.png"]
+    assert len(coco["annotations"]) == 1
+    assert progress[0] == (0, 2) and progress[-1] == (2, 2)
+
+
+def test_dims_change_rewrites_image(project, images):
+    annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    export(project)
+
+    cv2.imwrite(images["a.png"], np.zeros((80, 30, 3), dtype=np.uint8))
+    st = os.stat(images["a.png"])
+    os.utime(images["a.png"], ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    result, _ = export(project)
+    assert result["written"] == 1
+    assert manifest(project)["a.png"] == (1, 30, 80)
+
+
+def test_category_change_rebuilds(project, images):
+    annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    export(project)
+    with get_db_connection() as conn:
+        conn.execute("UPDATE project_state SET categories = ? WHERE project_id = ?", ('[{"name": "dog"}]', project))
+
+    result, _ = export(project)
+    assert result["rebuilt"] and result["written"] == 1
+
+
+def test_coco_rewritten_only_on_change(project, images):
+    annotation_service.save_annotations(project, "a.png", [shape("cat")])
+    result, _ = export(project, "coco")
+    path = os.path.join(result["path"], "annotations.json")
+    mtime = os.stat(path).st_mtime_ns
+
+    result, _ = export(project, "coco")
+    assert result["written"] == 0
+    assert os.stat(path).st_mtime_ns == mtime
+
+    annotation_service.save_annotations(project, "b.png", [shape("dog")])
+    result, _ = export(project, "coco")
+    assert result["written"] == 1
+    with open(path) as f:
+        assert sorted(img["file_name"] for img in json.load(f)["images"]) == ["a.png", "b.png"]
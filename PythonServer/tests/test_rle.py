@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+
+def reference_rle(mask):
+    """Straightforward column-major run-length encoding, starting with a run of 0s."""
+    flat = mask.T.ravel()
+    counts, current, run = [], False, 0
+    for value in flat:
+        if value == current:
+            run += 1
+        else:
+            counts.append(run)
+            current, run = value, 1
+    counts.append(run)
+    return {"size": list(mask.shape), "counts": counts}
+
+
+def reference_box(mask):
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        return [0, 0, 0, 0]
+    return [int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())]
+
+
+def random_masks(seed, n=200, max_dim=24):
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        h, w = rng.integers(1, max_dim, 2)
+        if i % 3 == 0:
+            yield rng.random((h, w)) < rng.random()
+        else:
+            mask = np.zeros((h, w), dtype=bool)
+            y0, y1 = sorted(rng.integers(0, h, 2))
+            x0, x1 = sorted(rng.integers(0, w, 2))
+            mask[y0:y1 + 1, x0:x1 + 1] = True
+            yield mask
+
+
+def test_decode_round_trip(sam2_utils):
+    rle = sam2_utils.rle
+    for mask in random_masks(0):
+        encoded = reference_rle(mask)
+        assert (rle.rle_to_mask(encoded) == mask).all()
+
+
+def test_batch_decode_matches_single(sam2_utils):
+    rle = sam2_utils.rle
+    rng = np.random.default_rng(1)
+    masks = rng.random((5, 7, 9)) < 0.4
+    decoded = rle.rles_to_masks([reference_rle(m) for m in masks])
+    assert decoded.shape == masks.shape
+    assert (decoded == masks).all()
+
+
+def test_area_and_box(sam2_utils):
+    rle = sam2_utils.rle
+    for mask in random_masks(2):
+        encoded = reference_rle(mask)
+        assert rle.rle_area(encoded) == int(mask.sum())
+        assert rle.rle_to_box(encoded) == reference_box(mask)
+
+
+def test_runs_round_trip(sam2_utils):
+    rle = sam2_utils.rle
+    for mask in random_masks(3):
+        encoded = reference_rle(mask)
+        starts, ends = rle.rle_foreground_runs(encoded)
+        rebuilt = rle.runs_to_rle(starts, ends, encoded["size"])
+        assert (rle.rle_to_mask(rebuilt) == mask).all()
+
+
+def test_merge_is_union(sam2_utils):
+    rle = sam2_utils.rle
+    rng = np.random.default_rng(4)
+    for _ in range(50):
+        h, w = rng.integers(1, 16, 2)
+        masks = rng.random((int(rng.integers(1, 4)), h, w)) < 0.3
+        merged = rle.merge_rles([reference_rle(m) for m in masks])
+        assert merged == reference_rle(masks.any(axis=0))
+
+
+def test_iou_matches_dense(sam2_utils):
+    rle = sam2_utils.rle
+    rng = np.random.default_rng(5)
+    a = rng.random((4, 12, 10)) < 0.4
+    b = rng.random((3, 12, 10)) < 0.4
+    b[0] = False  # Empty mask against everything
+    iou = rle.rle_iou([reference_rle(m) for m in a], [reference_rle(m) for m in b])
+    for i in range(len(a)):
+        for j in range(len(b)):
+            union = (a[i] | b[j]).sum()
+            expected = (a[i] & b[j]).sum() / union if union else 0.0
+            assert iou[i, j] == pytest.approx(expected)
+
+
+def test_encode_matches_reference(sam2_utils):
+    if not sam2_utils.has_torch:
+        pytest.skip("torch is not installed")
+    import torch
+
+    rle = sam2_utils.rle
+    rng = np.random.default_rng(6)
+    masks = rng.random((6, 11, 13)) < 0.5
+    masks[0] = False
+    masks[1] = True
+    encoded = rle.masks_to_rle(torch.from_numpy(masks))
+    assert encoded == [reference_rle(m) for m in masks]
+    assert rle.masks_to_rle(torch.zeros((0, 4, 4), dtype=torch.bool)) == []
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from test_rle import reference_box, reference_rle
+
+cv2 = pytest.importorskip("cv2")
+
+
+def cleaned_full(amg, mask, thresh):
+    """The full-image cleanup the box-restricted version must reproduce."""
+    mask, holes_changed = amg.remove_small_regions(mask, thresh, "holes")
+    mask, islands_changed = amg.remove_small_regions(mask, thresh, "islands")
+    return mask, holes_changed or islands_changed
+
+
+def random_cases(seed, n=1500, max_dim=40):
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        h, w = rng.integers(1, max_dim, 2)
+        mask = np.zeros((h, w), dtype=bool)
+        if i % 4 == 0:
+            mask = rng.random((h, w)) < rng.random()
+        else:
+            y0, y1 = sorted(rng.integers(0, h, 2))
+            x0, x1 = sorted(rng.integers(0, w, 2))
+            mask[y0:y1 + 1, x0:x1 + 1] = rng.random((y1 - y0 + 1, x1 - x0 + 1)) < rng.uniform(0.5, 1)
+        yield mask, float(rng.integers(1, 40))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_box_restricted_matches_full_image(sam2_utils, seed):
+    amg, rle = sam2_utils.amg, sam2_utils.rle
+    windowed = 0
+    for mask, thresh in random_cases(seed):
+        h, w = mask.shape
+        encoded = reference_rle(mask)
+        expected, expected_changed = cleaned_full(amg, mask, thresh)
+
+        region, (x0, y0, x1, y1), changed = amg.remove_small_regions_in_box(
+            rle.rle_to_mask(encoded), rle.rle_to_box(encoded), thresh)
+        assert changed == expected_changed
+        if (x0, y0, x1, y1) != (0, 0, w, h):
+            windowed += 1
+        if not changed:
+            continue
+
+        full = np.zeros((h, w), dtype=bool)
+        full[y0:y1, x0:x1] = region
+        assert (full == expected).all()
+        assert amg.region_to_box(region, [x0, y0, x1, y1]) == reference_box(expected)
+    assert windowed > 0  # The window path, not only the full-mask fallback, was exercised
+
+
+def test_island_and_hole_removed_inside_box(sam2_utils):
+    amg = sam2_utils.amg
+    mask = np.zeros((64, 64), dtype=bool)
+    mask[10:40, 10:40] = True
+    mask[20, 20] = False  # Small hole
+    mask[50, 50] = True  # Small island, outside the large square
+    box = reference_box(mask)
+
+    region, window, changed = amg.remove_small_regions_in_box(mask, box, 5)
+    assert changed
+    full = np.zeros_like(mask)
+    full[window[1]:window[3], window[0]:window[2]] = region
+    expected = np.zeros_like(mask)
+    expected[10:40, 10:40] = True
+    assert (full == expected).all()
+    assert amg.region_to_box(region, window) == [10, 10, 39, 39]